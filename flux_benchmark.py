@@ -0,0 +1,454 @@
+# ============================================================
+#  flux_benchmark.py
+#
+#  Benchmark for flux_imaging_api.py without the Flux weights
+#    - Stand-in pipelines (latency-configurable stub / tiny random Flux)
+#      are swapped in behind MODEL_INFO / PIPELINE_SPECS
+#    - Load generator for /process, /process/raw and /v1/images/*
+#    - Reports p50/p95/p99 latency, images/sec and per-stage timings as JSON
+#
+#  License: MIT
+# ============================================================
+
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import httpx
+import torch
+from PIL import Image
+
+ENDPOINTS = ["process", "process_raw", "generations", "edits", "variations"]
+
+
+# ---------- 代替パイプライン（stub） ----------
+# 実際の計算はせず，各段階で time.sleep する（GIL を手放すので GPU 待ちに近い振る舞いになる）．
+# 所要時間は STUB_LATENCY で設定する（秒）．step と vae はバッチの枚数に応じて増える
+STUB_LATENCY = {
+    "load": 0.0,            # from_pretrained
+    "text_encode": 0.005,   # プロンプト 1 件あたり
+    "redux": 0.01,          # 入力画像 1 枚あたり
+    "step": 0.02,           # 1 ステップあたり（バッチの 1 枚目）
+    "step_per_image": 0.01,  # 1 ステップあたり（バッチの 2 枚目以降の 1 枚ごと）
+    "vae": 0.02,            # 1 枚あたり
+}
+
+
+def _stub_image(generator, width, height):
+    # generator から決まる滑らかな画像（ノイズだけの画像より実際の出力に近い PNG サイズになる）
+    small = (torch.rand(max(1, height // 32), max(1, width // 32), 3, generator=generator) * 255).to(torch.uint8)
+    return Image.fromarray(small.numpy()).resize((width, height), Image.BILINEAR)
+
+
+class StubPipeline:
+    # ComponentRegistry と _infer_batch が使うメソッドだけを持つ
+    def __init__(self, name):
+        self.name = name
+        self.components = {}
+        self._num_timesteps = 0
+
+    @classmethod
+    def from_pretrained(cls, name, **kwargs):
+        time.sleep(STUB_LATENCY["load"])
+        return cls(name)
+
+    @property
+    def _execution_device(self):
+        return torch.device("cpu")
+
+    # LoRA・オフロード関連は何もしない
+    def load_lora_weights(self, *args, **kwargs):
+        pass
+
+    def set_adapters(self, *args, **kwargs):
+        pass
+
+    def fuse_lora(self, *args, **kwargs):
+        pass
+
+    def unload_lora_weights(self):
+        pass
+
+    def enable_lora(self):
+        pass
+
+    def disable_lora(self):
+        pass
+
+    def enable_model_cpu_offload(self):
+        pass
+
+    def remove_all_hooks(self):
+        pass
+
+    def encode_prompt(self, prompt, prompt_2=None):
+        time.sleep(STUB_LATENCY["text_encode"])
+        return torch.zeros(1, 8, 16), torch.zeros(1, 16), None
+
+    def __call__(self, prompt_embeds=None, pooled_prompt_embeds=None, generator=None, num_inference_steps=8,
+                 width=1024, height=1024, callback_on_step_end=None, image=None, guidance_scale=None):
+        batch = len(generator)
+        self._num_timesteps = num_inference_steps
+        for step in range(num_inference_steps):
+            time.sleep(STUB_LATENCY["step"] + STUB_LATENCY["step_per_image"] * (batch - 1))
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, None, {"latents": None})
+        time.sleep(STUB_LATENCY["vae"] * batch)
+        return SimpleNamespace(images=[_stub_image(g, width, height) for g in generator])
+
+
+class StubFluxPipeline(StubPipeline):
+    pass
+
+
+class StubKontextPipeline(StubPipeline):
+    pass
+
+
+class StubReduxPipeline(StubPipeline):
+    def __call__(self, images):
+        time.sleep(STUB_LATENCY["redux"] * len(images))
+        return SimpleNamespace(prompt_embeds=torch.zeros(len(images), 8, 16),
+                               pooled_prompt_embeds=torch.zeros(len(images), 16))
+
+
+# ---------- 代替パイプライン（tiny） ----------
+# diffusers のテストと同じ構成の，ランダム初期化した極小の Flux / Kontext / Redux．
+# 実際の diffusers のコード（スケジューラ・transformer・VAE）を通るので，CPU でも実装上の退行を拾える．
+# トークナイザは hf-internal-testing の極小モデルを取得する．VAE の縮小率が 1 なので，小さいサイズで使う
+def _tiny_text_encoders():
+    from transformers import AutoTokenizer, CLIPTextConfig, CLIPTextModel, CLIPTokenizer, T5EncoderModel
+
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0, eos_token_id=2, hidden_size=32, intermediate_size=37, layer_norm_eps=1e-05,
+        num_attention_heads=4, num_hidden_layers=5, pad_token_id=1, vocab_size=1000, hidden_act="gelu",
+        projection_dim=32,
+    ))
+    return {
+        "text_encoder": text_encoder,
+        "text_encoder_2": T5EncoderModel.from_pretrained("hf-internal-testing/tiny-random-t5"),
+        "tokenizer": CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip"),
+        "tokenizer_2": AutoTokenizer.from_pretrained("hf-internal-testing/tiny-random-t5"),
+    }
+
+
+def _tiny_components():
+    from diffusers import AutoencoderKL, FlowMatchEulerDiscreteScheduler, FluxTransformer2DModel
+
+    torch.manual_seed(0)
+    transformer = FluxTransformer2DModel(
+        patch_size=1, in_channels=4, num_layers=1, num_single_layers=1, attention_head_dim=16,
+        num_attention_heads=2, joint_attention_dim=32, pooled_projection_dim=32, axes_dims_rope=[4, 4, 8],
+    )
+    vae = AutoencoderKL(
+        sample_size=32, in_channels=3, out_channels=3, block_out_channels=(4,), layers_per_block=1,
+        latent_channels=1, norm_num_groups=1, use_quant_conv=False, use_post_quant_conv=False,
+        shift_factor=0.0609, scaling_factor=1.5035,
+    )
+    return {
+        "scheduler": FlowMatchEulerDiscreteScheduler(),
+        "transformer": transformer,
+        "vae": vae,
+        **_tiny_text_encoders(),
+    }
+
+
+def _tiny_pipeline_class(base):
+    class TinyPipeline(base):
+        @classmethod
+        def from_pretrained(cls, name, **kwargs):
+            return cls(**_tiny_components())
+
+        def enable_model_cpu_offload(self, *args, **kwargs):
+            if torch.cuda.is_available():
+                super().enable_model_cpu_offload(*args, **kwargs)
+
+        def __call__(self, *args, **kwargs):
+            if "image" in kwargs:
+                # Kontext は既定で入力画像を約 1024x1024 に拡大するので，入力画像のサイズのまま使う
+                kwargs.setdefault("_auto_resize", False)
+            return super().__call__(*args, **kwargs)
+
+    TinyPipeline.__name__ = f"Tiny{base.__name__}"
+    return TinyPipeline
+
+
+def _tiny_redux_class():
+    from diffusers import FluxPriorReduxPipeline
+    from diffusers.pipelines.flux.modeling_flux import ReduxImageEncoder
+    from transformers import SiglipImageProcessor, SiglipVisionConfig, SiglipVisionModel
+
+    class TinyFluxPriorReduxPipeline(FluxPriorReduxPipeline):
+        @classmethod
+        def from_pretrained(cls, name, **kwargs):
+            torch.manual_seed(0)
+            # テキストエンコーダを渡しておくと，埋め込みの次元が tiny の transformer と揃う
+            text = _tiny_text_encoders()
+            return cls(
+                image_encoder=SiglipVisionModel(SiglipVisionConfig(
+                    hidden_size=32, intermediate_size=37, num_hidden_layers=1, num_attention_heads=2,
+                    image_size=32, patch_size=8,
+                )),
+                feature_extractor=SiglipImageProcessor(size={"height": 32, "width": 32}),
+                image_embedder=ReduxImageEncoder(redux_dim=32, txt_in_features=32),
+                **text,
+            )
+
+    return TinyFluxPriorReduxPipeline
+
+
+def install_backend(api, backend):
+    # API の MODEL_INFO / PIPELINE_SPECS を代替パイプラインに差し替える
+    if backend == "stub":
+        classes = {"generate": StubFluxPipeline, "edit": StubKontextPipeline, "prior": StubReduxPipeline}
+    else:
+        from diffusers import FluxKontextPipeline, FluxPipeline
+        classes = {"generate": _tiny_pipeline_class(FluxPipeline), "edit": _tiny_pipeline_class(FluxKontextPipeline),
+                   "prior": _tiny_redux_class()}
+    for mode in api.MODEL_INFO:
+        api.MODEL_INFO[mode]["base_model"] = f"{backend}/{mode}"
+        if backend == "tiny":
+            api.MODEL_INFO[mode]["loras"] = []  # 極小の transformer には本物の LoRA は載らない
+    for mode, spec in api.PIPELINE_SPECS.items():
+        spec["pipeline"] = classes["edit" if mode == "edit" else "generate"]
+        spec["base_model"] = api.MODEL_INFO["edit" if mode == "edit" else "generate"]["base_model"]
+        if "prior" in spec:
+            spec["prior"] = classes["prior"]
+            spec["prior_model"] = api.MODEL_INFO["variation"]["base_model"]
+    api.registry.cache_dir = None
+
+
+# ---------- 負荷生成 ----------
+def _input_png(size) -> bytes:
+    width, height = size
+    buf = io.BytesIO()
+    _stub_image(torch.Generator().manual_seed(0), width, height).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _request_args(endpoint, i, args, input_png):
+    # i 番目のリクエストの httpx.AsyncClient.post の引数（seed は固定の列で再現可能にする）
+    seed = args.seed_base + i
+    size = f"{args.width}x{args.height}"
+    if endpoint in ("process", "process_raw"):
+        data = {"seed": seed, "width": args.width, "height": args.height, "output_format": args.output_format}
+        if args.steps:
+            data["num_inference_steps"] = args.steps
+        if args.mode != "variation":
+            data["prompt"] = f"benchmark prompt {i % args.unique_prompts}"
+        files = {"input_file": ("input.png", input_png, "image/png")} if args.mode != "generate" else None
+        url = "/process" if endpoint == "process" else "/process/raw"
+        return url, {"data": data, "files": files}
+    common = {"n": args.n, "size": size, "response_format": "b64_json", "seed": seed,
+              "output_format": args.output_format}
+    if endpoint == "generations":
+        return "/v1/images/generations", {"json": {"prompt": f"benchmark prompt {i % args.unique_prompts}", **common}}
+    files = {"image": ("input.png", input_png, "image/png")}
+    if endpoint == "edits":
+        return "/v1/images/edits", {"data": {"prompt": f"benchmark prompt {i % args.unique_prompts}", **common},
+                                    "files": files}
+    return "/v1/images/variations", {"data": common, "files": files}
+
+
+def parse_server_timing(header) -> dict:
+    timings = {}
+    for part in (header or "").split(","):
+        name, _, dur = part.strip().partition(";dur=")
+        if name and dur:
+            timings[name] = float(dur) / 1000
+    return timings
+
+
+def percentile(values, q):
+    # 線形補間によるパーセンタイル
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def summarize(values) -> dict:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else None,
+        "max": max(values) if values else None,
+    }
+
+
+async def _post(client, url, kwargs, errors):
+    # 失敗（接続エラー・200 以外）は errors に種類ごとに数えて None を返す
+    try:
+        resp = await client.post(url, **kwargs)
+    except httpx.HTTPError as e:
+        errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+        return None
+    if resp.status_code != 200:
+        errors[str(resp.status_code)] = errors.get(str(resp.status_code), 0) + 1
+        return None
+    return resp
+
+
+async def run_scenario(client, endpoint, concurrency, args, input_png) -> dict:
+    images_per_request = args.n if endpoint in ("generations", "edits", "variations") else 1
+    # ウォームアップ（パイプラインの読み込みなど）は集計に含めない．失敗は warmup_errors に残す
+    warmup_errors = {}
+    for i in range(args.warmup):
+        url, kwargs = _request_args(endpoint, args.requests + i, args, input_png)
+        await _post(client, url, kwargs, warmup_errors)
+
+    latencies, stages, errors = [], {}, {}
+    counter = iter(range(args.requests))
+
+    async def worker():
+        for i in counter:
+            url, kwargs = _request_args(endpoint, i, args, input_png)
+            start = time.monotonic()
+            resp = await _post(client, url, kwargs, errors)
+            if resp is None:
+                continue
+            elapsed = time.monotonic() - start
+            latencies.append(elapsed)
+            for stage, seconds in parse_server_timing(resp.headers.get("server-timing")).items():
+                stages.setdefault(stage, []).append(seconds)
+
+    start = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.monotonic() - start
+    return {
+        "endpoint": endpoint,
+        "mode": args.mode if endpoint in ("process", "process_raw") else None,
+        "concurrency": concurrency,
+        "n": images_per_request,
+        "requests": args.requests,
+        "ok": len(latencies),
+        "errors": errors,
+        "warmup_errors": warmup_errors,
+        "wall_seconds": wall,
+        "requests_per_second": len(latencies) / wall,
+        "images_per_second": len(latencies) * images_per_request / wall,
+        "latency": summarize(latencies),
+        "stages": {stage: summarize(values) for stage, values in sorted(stages.items())},
+    }
+
+
+async def run_benchmark(base_url, args) -> list:
+    input_png = _input_png((args.width, args.height))
+    limits = httpx.Limits(max_connections=max(args.concurrency) * 2)
+    reports = []
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        for endpoint in args.endpoints:
+            for concurrency in args.concurrency:
+                report = await run_scenario(client, endpoint, concurrency, args, input_png)
+                print(f"{endpoint} c={concurrency}: p50={report['latency']['p50']} "
+                      f"{report['images_per_second']:.2f} img/s", file=sys.stderr)
+                reports.append(report)
+    return reports
+
+
+def start_server(api, port):
+    # API を同じプロセスのスレッドで起動する（代替パイプラインに差し替えた状態で動かすため）
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="benchmark-server", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+# ---------- コマンドライン ----------
+def _csv(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="flux_imaging_api のベンチマーク")
+    parser.add_argument("--backend", choices=["stub", "tiny"], default="stub",
+                        help="代替パイプライン（stub: 遅延のみ，tiny: ランダム初期化の極小 Flux．"
+                             "tiny は初回に Hugging Face Hub から極小の T5・トークナイザを取得するのでネットワークが必要）")
+    parser.add_argument("--url", default=None, help="既に起動している API に対して計測する（代替パイプラインは使わない）")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--endpoints", type=_csv, default=ENDPOINTS, help=f"カンマ区切り（{','.join(ENDPOINTS)}）")
+    parser.add_argument("--concurrency", type=lambda v: [int(c) for c in _csv(v)], default=[1, 4],
+                        help="同時リクエスト数（カンマ区切りで複数指定可）")
+    parser.add_argument("--requests", type=int, default=32, help="シナリオごとのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=1, help="シナリオごとのウォームアップのリクエスト数")
+    parser.add_argument("--n", type=int, default=1, help="/v1/images/* の n")
+    parser.add_argument("--mode", choices=["generate", "edit", "variation"], default="generate",
+                        help="/process と /process/raw のモード")
+    parser.add_argument("--width", type=int, default=None, help="デフォルト: stub は 1024，tiny は 64")
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--steps", type=int, default=None, help="/process の num_inference_steps")
+    parser.add_argument("--output-format", default="png")
+    parser.add_argument("--unique-prompts", type=int, default=4, help="使い回すプロンプトの種類数")
+    parser.add_argument("--seed-base", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--latency", type=json.loads, default={},
+                        help=f'stub の遅延（秒）の上書き．JSON（例: \'{{"step": 0.05}}\'，キー: {",".join(STUB_LATENCY)}）')
+    parser.add_argument("--output", default=None, help="結果の JSON の書き出し先（デフォルト: 標準出力）")
+    args = parser.parse_args(argv)
+
+    default_size = 64 if args.backend == "tiny" else 1024
+    args.width = args.width or default_size
+    args.height = args.height or default_size
+    torch.manual_seed(args.seed_base)
+
+    server = None
+    if args.url:
+        base_url = args.url
+    else:
+        # API は import 時に環境変数を読むので，その前に計測用の設定にする
+        workdir = tempfile.mkdtemp(prefix="flux-bench-")
+        os.environ["JOB_DB_PATH"] = os.path.join(workdir, "jobs.sqlite3")
+        os.environ["MAX_QUEUE_SIZE"] = os.environ.get("MAX_QUEUE_SIZE", str(max(16, max(args.concurrency) * args.n)))
+        for name in ("FILE_SERVER", "RESULT_STORAGE", "RESULT_CACHE_DIR", "PIPELINE_CACHE_DIR", "PRELOAD_MODES"):
+            os.environ.pop(name, None)
+        STUB_LATENCY.update(args.latency)
+        import flux_imaging_api as api
+        install_backend(api, args.backend)
+        server, thread = start_server(api, args.port)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        scenarios = asyncio.run(run_benchmark(base_url, args))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join(timeout=10)
+
+    report = {
+        "config": {
+            "backend": None if args.url else args.backend,
+            "url": base_url,
+            "size": f"{args.width}x{args.height}",
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "output_format": args.output_format,
+            "stub_latency": STUB_LATENCY if not args.url and args.backend == "stub" else None,
+            "torch": torch.__version__,
+        },
+        "scenarios": scenarios,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,6 +17,7 @@
 #  License: MIT
 # ============================================================
 
+import abc
 import io
 import uuid
 import time
@@ -24,23 +25,112 @@ import json
 import httpx
 import os
 import base64
-from fastapi import FastAPI, Form, File, UploadFile, Body
-from fastapi.responses import JSONResponse, StreamingResponse
+import asyncio
+import threading
+import logging
+import gc
+import sys
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import resource
+import collections
+import queue as queue_module
+import multiprocessing
+from multiprocessing import shared_memory
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, Form, File, UploadFile, Body, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+import numpy as np
 from PIL import Image
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 import torch
+import diffusers
 from diffusers import FluxPipeline, FluxKontextPipeline, FluxPriorReduxPipeline
 from diffusers.quantizers import PipelineQuantizationConfig
 
+logger = logging.getLogger("uvicorn.error")
+
 # ファイルサーバのベースURL（環境変数から取得，存在しない場合は None）
 FILE_SERVER = os.getenv("FILE_SERVER", None)
 
+# 結果画像の保存先（デフォルト: FILE_SERVER があれば http，なければ保存せず Base64 で返す）
+#   http:   FILE_SERVER の /upload にアップロードする
+#   local:  image_file_server.py の保存ディレクトリ（LOCAL_STORE_DIR）に直接書き込み，FILE_SERVER の URL を返す
+#   memory: メモリ上に保持する（削除しないので，再起動するまで増え続ける）
+RESULT_STORAGE = os.getenv("RESULT_STORAGE", "http" if FILE_SERVER else "")
+LOCAL_STORE_DIR = os.getenv("LOCAL_STORE_DIR", "/tmp/imgtmp")
+
+# パイプラインの遅延読み込み設定
+#   PRELOAD_MODES: 起動時にバックグラウンドで読み込んでおくモード（カンマ区切り，例: "generate,edit"）
+#   PIPELINE_MEMORY_BUDGET_GB: 読み込み済みパイプラインの合計メモリ量の上限（0 で無制限）．
+#     超えた場合は最も長く使われていないパイプラインを解放する
+PRELOAD_MODES = [m.strip() for m in os.getenv("PRELOAD_MODES", "").split(",") if m.strip()]
+PIPELINE_MEMORY_BUDGET_GB = float(os.getenv("PIPELINE_MEMORY_BUDGET_GB", "0"))
+
+# 量子化・LoRA 適用済みパイプラインのキャッシュ先（未設定ならキャッシュしない）．
+# `python flux_imaging_api.py build-cache` で事前に作成できる
+PIPELINE_CACHE_DIR = os.getenv("PIPELINE_CACHE_DIR", None)
+
+# プロンプト埋め込み（CLIP / T5 の出力）キャッシュの上限（MiB，0 で無効）
+PROMPT_CACHE_MB = float(os.getenv("PROMPT_CACHE_MB", "256"))
+# 入力画像キャッシュの上限（MiB，0 で無効）．画像バイト列のハッシュをキーに
+#   IMAGE_CACHE_MB: デコード済みの RGB 画像
+#   REDUX_CACHE_MB: Redux prior の出力（prompt_embeds / pooled_prompt_embeds）
+IMAGE_CACHE_MB = float(os.getenv("IMAGE_CACHE_MB", "256"))
+REDUX_CACHE_MB = float(os.getenv("REDUX_CACHE_MB", "256"))
+
+# 結果画像キャッシュ（seed を指定した同一リクエストの結果を再利用する）の保存先と上限（MiB）．
+# RESULT_CACHE_DIR が未設定なら無効
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", None)
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", "1024"))
+
+# 入力画像の取得とファイルサーバへのアップロードに使う HTTP 接続プールの設定
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+# input_image_url から取得する画像の最大バイト数（超えると 413）
+MAX_INPUT_IMAGE_BYTES = int(os.getenv("MAX_INPUT_IMAGE_BYTES", str(50 * 1024 * 1024)))
+
+# PNG 出力の zlib 圧縮レベル（0〜9．小さいほど速く，ファイルは大きくなる）
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "6"))
+
+# 非同期ジョブ API（/jobs）の保存先 SQLite ファイルと同時実行数
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "/tmp/flux_jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+# 推論ワーカープロセスの構成（デフォルト: なし = このプロセスで推論する）．
+# ";" 区切りで 1 ワーカーずつ「デバイス=担当モード（カンマ区切り，省略時は全モード）」を書く．
+# 例: "cuda:0=generate,variation;cuda:1=edit"，動作確認用に "cpu" も指定できる
+INFERENCE_WORKERS = [w.strip() for w in os.getenv("INFERENCE_WORKERS", "").split(";") if w.strip()]
+# このキュー深さまでは，モード（LoRA）が読み込み済みのワーカーを優先する．超えたら空いているワーカーへ回す
+WORKER_AFFINITY_DEPTH = int(os.getenv("WORKER_AFFINITY_DEPTH", "8"))
+
+# 推論キューの上限（実行中を除く待ち数．超えると 503 + Retry-After を返す）
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "16"))
+
+# 一括処理（/v1/images/batch と batch コマンド）で同時に推論キューへ投入する件数の上限．
+# 推論キューを使い切って通常のリクエストが 503 にならないよう，デフォルトはキュー上限の半分
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "0")) or max(1, MAX_QUEUE_SIZE // 2)
+
+# マイクロバッチ設定（同じモード・解像度・ステップ数・guidance の仕事をまとめる）
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "50"))
+# 1 回のパイプライン呼び出しで扱う総画素数の上限（幅×高さ×枚数）．
+# n が大きいリクエストはこれを超えないようにチャンクに分けて実行される
+BATCH_MAX_PIXELS = int(os.getenv("BATCH_MAX_PIXELS", str(4 * 1024 * 1024)))
+# 1 リクエストで生成できる枚数（n）の上限
+MAX_N = int(os.getenv("MAX_N", "10"))
+
 # 量子化設定
-pipeline_quant_config = PipelineQuantizationConfig(
-    quant_backend="bitsandbytes_4bit",
-    quant_kwargs={"load_in_4bit": True, "bnb_4bit_quant_type": "nf4", "bnb_4bit_compute_dtype": torch.bfloat16},
-    components_to_quantize=["transformer", "text_encoder_2"],
-)
+QUANT_SETTINGS = {
+    "quant_backend": "bitsandbytes_4bit",
+    "quant_kwargs": {"load_in_4bit": True, "bnb_4bit_quant_type": "nf4", "bnb_4bit_compute_dtype": torch.bfloat16},
+    "components_to_quantize": ["transformer", "text_encoder_2"],
+}
+pipeline_quant_config = PipelineQuantizationConfig(**QUANT_SETTINGS)
 
 # --- デフォルト設定（seed は削除） ---
 DEFAULTS = {
@@ -49,6 +139,13 @@ DEFAULTS = {
     "variation": {"guidance_scale": 2.5, "num_inference_steps": 8},
 }
 
+# --- 出力形式（output_format -> PIL のフォーマット名, MIME タイプ, 拡張子） ---
+OUTPUT_FORMATS = {
+    "png": ("PNG", "image/png", ".png"),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+}
+
 # --- モデル/LoRA情報 ---
 MODEL_INFO = {
     "edit": {"base_model": "LPX55/FLUX.1_Kontext-Lightning", "loras": []},
@@ -62,74 +159,936 @@ MODEL_INFO = {
     },
 }
 
-# --- 編集用パイプライン (FluxKontext) ---
-pipe_edit = FluxKontextPipeline.from_pretrained(
-    MODEL_INFO["edit"]["base_model"],
-    quantization_config=pipeline_quant_config,
-    torch_dtype=torch.bfloat16,
-)
-if MODEL_INFO["edit"]["loras"]:
-    adapter_names, adapter_weights = [], []
-    for i, lora in enumerate(MODEL_INFO["edit"]["loras"]):
-        adapter_name = f"edit_lora{i}"
-        pipe_edit.load_lora_weights(
-            pretrained_model_name_or_path_or_dict="loras_kontext",
-            weight_name=lora["weight_name"],
-            adapter_name=adapter_name
-        )
-        adapter_names.append(adapter_name)
-        adapter_weights.append(lora["adapter_weight"])
-    pipe_edit.set_adapters(adapter_names, adapter_weights)
-pipe_edit.enable_model_cpu_offload()
-
-# --- 生成用パイプライン (Flux) ---
-pipe_gen = FluxPipeline.from_pretrained(
-    MODEL_INFO["generate"]["base_model"],
-    quantization_config=pipeline_quant_config,
-    torch_dtype=torch.bfloat16,
-)
-if MODEL_INFO["generate"]["loras"]:
-    adapter_names, adapter_weights = [], []
-    for i, lora in enumerate(MODEL_INFO["generate"]["loras"]):
-        adapter_name = f"gen_lora{i}"
-        pipe_gen.load_lora_weights(
-            pretrained_model_name_or_path_or_dict="loras",
-            weight_name=lora["weight_name"],
-            adapter_name=adapter_name
-        )
-        adapter_names.append(adapter_name)
-        adapter_weights.append(lora["adapter_weight"])
-    pipe_gen.set_adapters(adapter_names, adapter_weights)
-pipe_gen.enable_model_cpu_offload()
-
-# --- バリエーション用パイプライン (FluxPriorRedux) ---
-pipe_var = FluxPipeline.from_pretrained(
-    MODEL_INFO["generate"]["base_model"],
-    quantization_config=pipeline_quant_config,
-    text_encoder=None,
-    text_encoder_2=None,
-    torch_dtype=torch.bfloat16,
-)
-pipe_prior_redux = FluxPriorReduxPipeline.from_pretrained(
-    MODEL_INFO["variation"]["base_model"],
-    quantization_config=pipeline_quant_config,
-    torch_dtype=torch.bfloat16,
-)
-if MODEL_INFO["variation"]["loras"]:
-    adapter_names, adapter_weights = [], []
-    for i, lora in enumerate(MODEL_INFO["variation"]["loras"]):
-        adapter_name = f"var_lora{i}"
-        pipe_var.load_lora_weights(
-            pretrained_model_name_or_path_or_dict="loras",
-            weight_name=lora["weight_name"],
-            adapter_name=adapter_name
-        )
-        adapter_names.append(adapter_name)
-        adapter_weights.append(lora["adapter_weight"])
-    pipe_var.set_adapters(adapter_names, adapter_weights)
-pipe_var.enable_model_cpu_offload()
+# --- モードごとのパイプライン構成（クラス・ベースモデル・LoRA の読み込み元） ---
+# variation は Redux prior の出力を FLUX.1-dev に渡すので，生成用と同じベースモデルを共有する
+PIPELINE_SPECS = {
+    "edit": {
+        "pipeline": FluxKontextPipeline, "base_model": MODEL_INFO["edit"]["base_model"], "lora_dir": "loras_kontext",
+    },
+    "generate": {
+        "pipeline": FluxPipeline, "base_model": MODEL_INFO["generate"]["base_model"], "lora_dir": "loras",
+    },
+    "variation": {
+        "pipeline": FluxPipeline, "base_model": MODEL_INFO["generate"]["base_model"], "lora_dir": "loras",
+        "prior": FluxPriorReduxPipeline, "prior_model": MODEL_INFO["variation"]["base_model"],
+    },
+}
+
+
+# ---------- 計測（Prometheus） ----------
+# 段階ごとの所要時間はミリ秒〜数分まで幅があるので，バケットも広めに取る
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+STAGE_SECONDS = Histogram(
+    "flux_stage_seconds", "Duration of each processing stage", ["stage"], buckets=TIME_BUCKETS)
+REQUEST_SECONDS = Histogram(
+    "flux_http_request_seconds", "HTTP request duration", ["method", "route", "status"], buckets=TIME_BUCKETS)
+PIPELINE_LOAD_SECONDS = Histogram(
+    "flux_pipeline_load_seconds", "Pipeline load duration", ["pipeline", "source"], buckets=TIME_BUCKETS)
+BATCH_SIZE = Histogram(
+    "flux_batch_size", "Images per pipeline call", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+IMAGES_TOTAL = Counter("flux_images_total", "Result images returned", ["mode", "cache"])
+QUEUE_DEPTH = Gauge("flux_queue_depth", "Images waiting for or running inference")
+GPU_PEAK_BYTES = Gauge("flux_gpu_memory_peak_bytes", "Peak allocated CUDA memory", ["device"])
+HOST_PEAK_BYTES = Gauge("flux_host_memory_peak_bytes", "Peak resident set size of this process")
+
+
+@contextmanager
+def timed(stage, timings=None):
+    # with ブロックの所要時間を STAGE_SECONDS に記録し，timings（dict）があればそこにも書く
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def server_timing(timings, start=None) -> str:
+    # Server-Timing ヘッダの値（ミリ秒）．start を渡すとそこからの経過時間を total として付ける
+    if start is not None:
+        timings = {**timings, "total": time.monotonic() - start}
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def update_memory_metrics():
+    # メモリの最大使用量（high-water mark）を反映する（ru_maxrss は Linux では KiB 単位）
+    HOST_PEAK_BYTES.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            GPU_PEAK_BYTES.labels(f"cuda:{i}").set(torch.cuda.max_memory_allocated(i))
+
+
+def _cache_hash() -> str:
+    # MODEL_INFO・LoRA ファイル・量子化設定・diffusers のバージョンが変わればキャッシュは別物になる
+    loras = {}
+    for mode, spec in PIPELINE_SPECS.items():
+        for lora in MODEL_INFO[mode]["loras"]:
+            path = os.path.join(spec["lora_dir"], lora["weight_name"])
+            st = os.stat(path) if os.path.exists(path) else None
+            loras[path] = [st.st_size, st.st_mtime_ns] if st else None
+    payload = {
+        "model_info": MODEL_INFO,
+        "lora_files": loras,
+        "quant": QUANT_SETTINGS,
+        "diffusers": diffusers.__version__,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _module_bytes(module: torch.nn.Module) -> int:
+    # パラメータとバッファの実メモリ量（4bit 量子化済みの重みはパック後のサイズ）
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ComponentRegistry:
+    # ベースモデルごとにパイプライン（transformer / VAE / テキストエンコーダ）を 1 度だけ読み込み，
+    # 複数のモードで共有する．LoRA アダプタも同じファイルは 1 度だけ読み込み，
+    # 呼び出しごとにモードのアダプタの組へ切り替える．
+    # パイプラインは初回利用時に読み込み，合計メモリ量が memory_budget（バイト，0 で無制限）を
+    # 超えたら最も長く使われていないものから解放する（LRU）．
+    # cache_dir を指定すると，量子化済み（共有する全モードの LoRA が同じなら LoRA 融合済み）の
+    # パイプラインを safetensors で保存し，次回以降はそこから読み込む．
+    # _lock は読み込み（数分かかる）の間ずっと保持されるので，/status などイベントループから読む状態は
+    # 変更のたびに _publish() で作るスナップショット（_snapshot_lock で短時間だけ保護）から返す．
+    def __init__(self, memory_budget: int = 0, cache_dir: str = None):
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
+        self._lock = threading.RLock()
+        self._snapshot_lock = threading.Lock()
+        self._snapshot = {"warm": [], "loading": [], "resident": [], "footprint": [], "evictions": 0}
+        self._pipelines = collections.OrderedDict()  # (パイプラインクラス名, ベースモデル) -> パイプライン（LRU 順）
+        self._bytes = {}          # パイプラインの key -> メモリ量
+        self._adapters = {}       # (パイプラインの key, LoRA ディレクトリ, ファイル名) -> アダプタ名
+        self._mode_adapters = {}  # 読み込み済みのモード -> (アダプタ名のリスト, 重みのリスト)
+        self._active = {}         # パイプラインの key -> 現在有効なアダプタの組
+        self._in_use = set()      # 推論中で解放してはいけないパイプラインの key
+        self._fused = set()       # LoRA を融合済みのパイプラインの key
+        self._loading = set()     # 読み込み中のモード
+        self.load_seconds = {}
+        self.load_sources = {}    # パイプラインの key -> "cache" / "hub"
+        self.evictions = 0
+
+    @staticmethod
+    def _keys(mode):
+        spec = PIPELINE_SPECS[mode]
+        keys = [(spec["pipeline"].__name__, spec["base_model"])]
+        if "prior" in spec:
+            keys.append((spec["prior"].__name__, spec["prior_model"]))
+        return keys
+
+    def _cache_path(self, key):
+        if not self.cache_dir:
+            return None
+        name = f"{key[0]}--{key[1].replace('/', '--')}"
+        return os.path.join(self.cache_dir, _cache_hash(), name)
+
+    @staticmethod
+    def _shared_loras(key):
+        # key のパイプラインをデノイザとして使う全モードで LoRA の組が同じなら (ディレクトリ, LoRA リスト) を返す
+        sets = {(spec["lora_dir"], json.dumps(MODEL_INFO[mode]["loras"], sort_keys=True))
+                for mode, spec in PIPELINE_SPECS.items()
+                if (spec["pipeline"].__name__, spec["base_model"]) == key}
+        if len(sets) != 1:
+            return None
+        lora_dir, loras = sets.pop()
+        return lora_dir, json.loads(loras)
+
+    def _load(self, cls, base_model):
+        key = (cls.__name__, base_model)
+        if key in self._pipelines:
+            return key
+        start = time.monotonic()
+        path = self._cache_path(key)
+        shared = self._shared_loras(key) if path else None
+        if path and os.path.isdir(path):
+            # 量子化済みの重みをそのまま読み込む（safetensors はメモリマップで読まれる）
+            pipe = cls.from_pretrained(path, torch_dtype=torch.bfloat16, use_safetensors=True)
+            self.load_sources[key] = "cache"
+        else:
+            pipe = cls.from_pretrained(
+                base_model,
+                quantization_config=pipeline_quant_config,
+                torch_dtype=torch.bfloat16,
+            )
+            self.load_sources[key] = "hub"
+            if shared and shared[1]:
+                lora_dir, loras = shared
+                adapter_names = []
+                for i, lora in enumerate(loras):
+                    pipe.load_lora_weights(lora_dir, weight_name=lora["weight_name"], adapter_name=f"fused{i}")
+                    adapter_names.append(f"fused{i}")
+                pipe.set_adapters(adapter_names, [lora["adapter_weight"] for lora in loras])
+                pipe.fuse_lora(adapter_names=adapter_names)
+                pipe.unload_lora_weights()
+            if path:
+                tmp = f"{path}.tmp-{os.getpid()}"
+                pipe.save_pretrained(tmp, safe_serialization=True)
+                try:
+                    os.replace(tmp, path)
+                except OSError:
+                    shutil.rmtree(tmp, ignore_errors=True)  # 別プロセスが先に保存した
+                logger.info("cached %s (%s) to %s", base_model, cls.__name__, path)
+        if shared is not None:
+            self._fused.add(key)
+        self._pipelines[key] = pipe
+        self.load_seconds[key] = time.monotonic() - start
+        PIPELINE_LOAD_SECONDS.labels(cls.__name__, self.load_sources[key]).observe(self.load_seconds[key])
+        logger.info("loaded %s (%s) from %s in %.1fs",
+                    base_model, cls.__name__, self.load_sources[key], self.load_seconds[key])
+        return key
+
+    def _load_lora(self, key, lora_dir, weight_name):
+        if (key, lora_dir, weight_name) not in self._adapters:
+            adapter_name = f"lora{len(self._adapters)}"
+            self._pipelines[key].load_lora_weights(
+                pretrained_model_name_or_path_or_dict=lora_dir,
+                weight_name=weight_name,
+                adapter_name=adapter_name
+            )
+            self._adapters[(key, lora_dir, weight_name)] = adapter_name
+        return self._adapters[(key, lora_dir, weight_name)]
+
+    def load(self, mode):
+        # モードのパイプライン（と variation の場合は Redux prior）を読み込み，LRU の先頭に移す
+        with self._lock:
+            keys = self._keys(mode)
+            if mode not in self._mode_adapters:
+                self._loading.add(mode)
+                self._publish()
+                try:
+                    spec = PIPELINE_SPECS[mode]
+                    new = [key for key in keys if key not in self._pipelines]
+                    self._load(spec["pipeline"], spec["base_model"])
+                    adapter_names, adapter_weights = [], []
+                    # LoRA 融合済みのパイプラインではアダプタの切り替えは不要
+                    for lora in ([] if keys[0] in self._fused else MODEL_INFO[mode]["loras"]):
+                        adapter_names.append(self._load_lora(keys[0], spec["lora_dir"], lora["weight_name"]))
+                        adapter_weights.append(lora["adapter_weight"])
+                    if keys[0] in new and torch.cuda.is_available():
+                        self._pipelines[keys[0]].enable_model_cpu_offload()
+                    if "prior" in spec:
+                        # Redux prior は従来どおり CPU オフロードせずに使う
+                        self._load(spec["prior"], spec["prior_model"])
+                    for key in new:
+                        self._bytes[key] = sum(_module_bytes(c) for c in self._pipelines[key].components.values()
+                                               if isinstance(c, torch.nn.Module))
+                        logger.info("%s (%s): %.1f MiB", key[1], key[0], self._bytes[key] / 2**20)
+                    self._mode_adapters[mode] = (adapter_names, adapter_weights)
+                finally:
+                    self._loading.discard(mode)
+                    self._publish()
+            for key in keys:
+                self._pipelines.move_to_end(key)
+            if self._evict(keep=keys):
+                self._publish()
+            return [self._pipelines[key] for key in keys]
+
+    def _evict(self, keep) -> int:
+        # 解放したパイプラインの数を返す
+        evicted = 0
+        if not self.memory_budget:
+            return evicted
+        while sum(self._bytes.values()) > self.memory_budget:
+            victim = next((k for k in self._pipelines if k not in keep and k not in self._in_use), None)
+            if victim is None:
+                break
+            self._unload(victim)
+            evicted += 1
+        return evicted
+
+    def _unload(self, key):
+        pipe = self._pipelines.pop(key)
+        pipe.remove_all_hooks()
+        self._bytes.pop(key, None)
+        self._active.pop(key, None)
+        self._fused.discard(key)
+        self._adapters = {k: v for k, v in self._adapters.items() if k[0] != key}
+        for mode in [m for m in self._mode_adapters if key in self._keys(m)]:
+            del self._mode_adapters[mode]
+        del pipe
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.evictions += 1
+        logger.info("evicted %s (%s)", key[1], key[0])
+
+    @contextmanager
+    def use(self, mode):
+        # 推論ワーカーから呼ぶ．(パイプライン, Redux prior) を返し，使用中は解放されないようにする．
+        # 読み込みから使用中の印を付けるまでを 1 つのロック（RLock）の中で行い，
+        # その間に preload スレッドの load() が読み込んだばかりのパイプラインを解放しないようにする
+        with self._lock:
+            pipes = self.load(mode)
+            keys = self._keys(mode)
+            self._in_use.update(keys)
+            self._activate(mode, keys[0])
+        try:
+            yield pipes[0], (pipes[1] if len(pipes) > 1 else None)
+        finally:
+            with self._lock:
+                self._in_use.difference_update(keys)
+
+    def _activate(self, mode, key):
+        # 共有パイプラインのアダプタをモードの組に切り替える（同じ組なら何もしない）
+        adapter_names, adapter_weights = self._mode_adapters[mode]
+        state = (tuple(adapter_names), tuple(adapter_weights))
+        if self._active.get(key) == state:
+            return
+        pipe = self._pipelines[key]
+        if adapter_names:
+            pipe.enable_lora()
+            pipe.set_adapters(adapter_names, adapter_weights)
+        elif any(k[0] == key for k in self._adapters):
+            pipe.disable_lora()
+        self._active[key] = state
+
+    def preload(self, modes):
+        for mode in modes:
+            try:
+                self.load(mode)
+            except Exception:
+                logger.exception("failed to preload %s", mode)
+
+    def _publish(self):
+        # self._lock を保持した状態で呼ぶ．読み出し用のスナップショットを作り直す
+        rows, seen = [], set()
+        for (cls_name, base_model), pipe in self._pipelines.items():
+            for name, component in pipe.components.items():
+                # コンポーネントごとのメモリ量（共有されているモジュールは 1 度だけ数える）
+                if isinstance(component, torch.nn.Module) and id(component) not in seen:
+                    seen.add(id(component))
+                    rows.append({
+                        "pipeline": cls_name,
+                        "base_model": base_model,
+                        "component": name,
+                        "bytes": _module_bytes(component),
+                    })
+        snapshot = {
+            "warm": [mode for mode in PIPELINE_SPECS if mode in self._mode_adapters],
+            "loading": sorted(self._loading),
+            "resident": [{"pipeline": k[0], "base_model": k[1], "bytes": self._bytes.get(k),
+                          "source": self.load_sources.get(k), "load_seconds": self.load_seconds.get(k)}
+                         for k in self._pipelines],
+            "footprint": rows,
+            "evictions": self.evictions,
+        }
+        with self._snapshot_lock:
+            self._snapshot = snapshot
+
+    def warm_modes(self) -> list:
+        with self._snapshot_lock:
+            return list(self._snapshot["warm"])
+
+    def footprint(self) -> list:
+        with self._snapshot_lock:
+            return list(self._snapshot["footprint"])
+
+    def stats(self) -> dict:
+        with self._snapshot_lock:
+            snapshot = self._snapshot
+        return {
+            "warm": list(snapshot["warm"]),
+            "loading": list(snapshot["loading"]),
+            "resident": list(snapshot["resident"]),
+            "memory_budget": self.memory_budget,
+            "evictions": snapshot["evictions"],
+        }
+
+
+registry = ComponentRegistry(int(PIPELINE_MEMORY_BUDGET_GB * 2**30), PIPELINE_CACHE_DIR)
+
+
+# ---------- キャッシュ ----------
+def _tensor_bytes(*tensors) -> int:
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ByteLRUCache:
+    # 合計バイト数が max_bytes を超えたら最も古いものから捨てる LRU キャッシュ（スレッドセーフ）
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data = collections.OrderedDict()  # key -> (値, バイト数)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+
+    def put(self, key, value, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# (ベースモデル, LoRA の組, プロンプト) -> (prompt_embeds, pooled_prompt_embeds)（CPU 上に保持）
+prompt_cache = ByteLRUCache(int(PROMPT_CACHE_MB * 2**20))
+# 画像の sha256 -> デコード済み RGB 画像
+image_cache = ByteLRUCache(int(IMAGE_CACHE_MB * 2**20))
+# (Redux モデル, 画像の sha256) -> (prompt_embeds, pooled_prompt_embeds)（CPU 上に保持）
+redux_cache = ByteLRUCache(int(REDUX_CACHE_MB * 2**20))
+
+
+def _decode_image(data: bytes):
+    # 入力画像をデコードして (RGB 画像, sha256) を返す．同じバイト列は 2 回目以降デコードしない
+    digest = hashlib.sha256(data).hexdigest()
+    image = image_cache.get(digest)
+    if image is None:
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+        image_cache.put(digest, image, image.width * image.height * 3)
+    return image, digest
+
+
+class ResultCache:
+    # 結果画像（エンコード済みのバイト列）をディスクに保存する内容アドレス型キャッシュ．
+    # <directory>/<key の先頭2文字>/<key>.bin と，seed・サイズ・アップロード済み URL などの <key>.json を置く．
+    # 合計サイズが max_bytes を超えたら最も長く使われていないものから削除する（LRU はメモリ上の索引で管理）
+    def __init__(self, directory, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = collections.OrderedDict()  # key -> バイト数（LRU 順）
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        # 起動時に既存のエントリを更新時刻順に索引へ載せる
+        entries = []
+        for shard in os.scandir(directory):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".bin"):
+                        st = entry.stat()
+                        entries.append((st.st_mtime, entry.name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.bytes += size
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key[:2], key)
+        return base + ".bin", base + ".json"
+
+    def get(self, key):
+        # (バイト列, メタデータ) を返す．なければ None
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(data_path, "rb") as f:
+                data = f.read()
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except OSError:
+            with self._lock:
+                self.bytes -= self._index.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data, meta
+
+    def put(self, key, data: bytes, meta: dict):
+        data_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        self._write(meta_path, json.dumps(meta).encode())
+        self._write(data_path, data)
+        with self._lock:
+            self.bytes += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            victims = []
+            while self.bytes > self.max_bytes and len(self._index) > 1:
+                victim, size = self._index.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+                victims.append(victim)
+        for victim in victims:
+            for path in self._paths(victim):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _write(path, data: bytes):
+        # 一時ファイルに書いてから rename する（読み込み中のプロセスに途中の内容を見せない）
+        tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._index),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+result_cache = ResultCache(RESULT_CACHE_DIR, int(RESULT_CACHE_MB * 2**20)) if RESULT_CACHE_DIR else None
+
+
+def _result_key(pipeline_mode, prompt, seed, width, height, guidance_scale, num_inference_steps,
+                image_hash, output_format, output_compression) -> str:
+    # 結果を決めるものすべて（モデル・LoRA・パラメータ・入力画像・出力形式）のハッシュ
+    payload = {
+        "mode": pipeline_mode,
+        "model": PIPELINE_SPECS[pipeline_mode]["base_model"],
+        "model_info": MODEL_INFO[pipeline_mode],
+        "prompt": prompt,
+        "seed": seed,
+        "size": [width, height],
+        "guidance_scale": guidance_scale,
+        "num_inference_steps": num_inference_steps,
+        "input_image": image_hash,
+        "output": [output_format, output_compression, PNG_COMPRESS_LEVEL if output_format == "png" else None],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+# ---------- 推論ワーカー ----------
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("inference queue is full")
+        self.retry_after = retry_after
+
+
+class InferenceCancelled(Exception):
+    pass
+
+
+def _resolve_future(future, result=None, exc=None):
+    # イベントループ側で呼ばれる（クライアント切断でキャンセル済みなら何もしない）
+    if future.cancelled():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+class _WorkItem:
+    # キュー上の 1 画像分の仕事（key が同じものは 1 回のパイプライン呼び出しにまとめられる）
+    __slots__ = ("key", "payload", "loop", "future")
+
+    def __init__(self, key, payload, loop, future):
+        self.key = key
+        self.payload = payload
+        self.loop = loop
+        self.future = future
+
+
+class InferenceExecutor:
+    # パイプラインを専有する推論ワーカー．
+    # ハンドラは submit() で仕事を投入して Future を await する．
+    # 推論は専用スレッドで実行されるので，イベントループはブロックされない．
+    # 先頭の仕事と key が同じ仕事を max_wait 秒まで（最大 batch_limit(key) 件）待って集め，
+    # run_batch(key, payloads, is_cancelled) の 1 回の呼び出しでまとめて処理する（マイクロバッチ）．
+    # is_cancelled() はバッチ内の仕事がすべてキャンセルされたら True を返す．
+    def __init__(self, run_batch, max_queue_size: int, batch_limit=lambda key: 1, max_wait: float = 0.0):
+        self.run_batch = run_batch
+        self.max_queue_size = max_queue_size
+        self.batch_limit = batch_limit
+        self.max_wait = max_wait
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._running = 0
+        self._avg_seconds = None  # 1画像あたりの処理時間（指数移動平均）
+        self._batches = 0
+        self._batched_items = 0
+        self._thread = None
 
-app = FastAPI()
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, name="inference-worker", daemon=True)
+            self._thread.start()
+
+    def retry_after(self) -> int:
+        # 待ち件数 × 平均処理時間 から再試行までの目安秒数を見積もる
+        avg = self._avg_seconds or 10.0
+        return max(1, int(avg * (len(self._pending) + self._running)))
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._pending) + self._running,
+            "pending": len(self._pending),
+            "running": self._running,
+            "max_queue_size": self.max_queue_size,
+            "avg_seconds": self._avg_seconds,
+            "avg_batch_size": self._batched_items / self._batches if self._batches else None,
+        }
+
+    def submit(self, key, payloads):
+        # 同じ key の複数画像（n > 1）をまとめて投入し，画像ごとの Future のリストを返す
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in payloads]
+        with self._cond:
+            # n 枚分をまとめて数える．上限より大きい n でもキューが空なら 1 件だけ受け付ける
+            if self._pending and len(self._pending) + len(payloads) > self.max_queue_size:
+                raise QueueFullError(self.retry_after())
+            for payload, future in zip(payloads, futures):
+                self._pending.append(_WorkItem(key, payload, loop, future))
+            self._cond.notify_all()
+        return futures
+
+    def _take_batch(self):
+        # self._cond を保持した状態で呼ぶ
+        while not self._pending:
+            self._cond.wait()
+        batch = [self._pending.popleft()]
+        key = batch[0].key
+        limit = max(1, self.batch_limit(key))
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < limit:
+            for item in list(self._pending):
+                if item.key == key:
+                    self._pending.remove(item)
+                    batch.append(item)
+                    if len(batch) >= limit:
+                        break
+            remaining = deadline - time.monotonic()
+            if len(batch) >= limit or remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        return key, batch
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                key, batch = self._take_batch()
+                # 待っている間にクライアントが切断したものは除く
+                batch = [item for item in batch if not item.future.cancelled()]
+                if not batch:
+                    continue
+                self._running = len(batch)
+            start = time.monotonic()
+            try:
+                results = self.run_batch(key, [item.payload for item in batch],
+                                         lambda: all(item.future.cancelled() for item in batch))
+            except Exception as e:
+                for item in batch:
+                    item.loop.call_soon_threadsafe(_resolve_future, item.future, None, e)
+            else:
+                for item, result in zip(batch, results):
+                    item.loop.call_soon_threadsafe(_resolve_future, item.future, result)
+            finally:
+                per_item = (time.monotonic() - start) / len(batch)
+                with self._cond:
+                    self._running = 0
+                    self._batches += 1
+                    self._batched_items += len(batch)
+                    if self._avg_seconds is None:
+                        self._avg_seconds = per_item
+                    else:
+                        self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * per_item
+
+
+# ---------- HTTP クライアント ----------
+class InputTooLargeError(Exception):
+    pass
+
+
+# アプリ全体で共有する接続プール（lifespan で作成・破棄する）
+http_client: httpx.AsyncClient = None
+
+
+def _make_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        verify=False,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        timeout=HTTP_TIMEOUT,
+    )
+
+
+async def fetch_image_bytes(url, headers=None) -> bytes:
+    # 入力画像をストリーミングで取得する．MAX_INPUT_IMAGE_BYTES を超えたら途中で打ち切る
+    async with http_client.stream("GET", url, headers=headers) as resp:
+        resp.raise_for_status()
+        length = resp.headers.get("content-length")
+        if length and int(length) > MAX_INPUT_IMAGE_BYTES:
+            raise InputTooLargeError(url)
+        data = bytearray()
+        async for chunk in resp.aiter_bytes():
+            data += chunk
+            if len(data) > MAX_INPUT_IMAGE_BYTES:
+                raise InputTooLargeError(url)
+    return bytes(data)
+
+
+# ---------- 結果画像の保存先 ----------
+class ResultStorage(abc.ABC):
+    # put() で結果画像を保存して URL を返す
+    @abc.abstractmethod
+    async def put(self, data: bytes, output_format: str) -> str:
+        ...
+
+
+class HTTPFileServerStorage(ResultStorage):
+    # FILE_SERVER の /upload にアップロードする（従来の動作）
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    async def put(self, data, output_format):
+        _, media_type, ext = OUTPUT_FORMATS[output_format]
+        files = {"file": (f"{uuid.uuid4()}{ext}", data, media_type)}
+        up_resp = await http_client.post(f"{self.base_url}/upload", files=files)
+        up_resp.raise_for_status()
+        return f"{self.base_url}{up_resp.json()['url']}"
+
+
+class LocalDirStorage(ResultStorage):
+    # image_file_server.py と同じ配置（内容の sha256 の先頭 32 桁 + 拡張子を ID とし，
+    # 先頭 4 桁で 2 段のディレクトリに分ける）で保存ディレクトリへ直接書き込む．
+    # 同じホストで動かすときにアップロード（multipart への詰め直しと HTTP の往復）を省ける．
+    # .incoming/ に置いた目印で，ファイルサーバの索引（/latest や削除処理）にも反映される
+    def __init__(self, directory, base_url):
+        self.directory = directory
+        self.base_url = base_url or ""
+
+    def _write(self, data, ext):
+        fid = f"{hashlib.sha256(data).hexdigest()[:32]}{ext}"
+        path = os.path.join(self.directory, fid[:2], fid[2:4], fid)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = os.path.join(self.directory, f".tmp-{os.getpid()}-{uuid.uuid4().hex}")
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        incoming = os.path.join(self.directory, ".incoming")
+        os.makedirs(incoming, exist_ok=True)
+        open(os.path.join(incoming, fid), "wb").close()
+        return fid
+
+    async def put(self, data, output_format):
+        fid = await asyncio.to_thread(self._write, data, OUTPUT_FORMATS[output_format][2])
+        return f"{self.base_url}/i/{fid}"
+
+
+class MemoryStorage(ResultStorage):
+    # メモリ上に保持する（削除はしない）．URL は memory://{fid}，中身は files[fid]
+    def __init__(self):
+        self.files = {}
+
+    async def put(self, data, output_format):
+        fid = f"{hashlib.sha256(data).hexdigest()[:32]}{OUTPUT_FORMATS[output_format][2]}"
+        self.files[fid] = data
+        return f"memory://{fid}"
+
+
+def make_storage(kind):
+    if not kind:
+        return None
+    if kind == "http":
+        if not FILE_SERVER:
+            raise ValueError("RESULT_STORAGE=http requires FILE_SERVER")
+        return HTTPFileServerStorage(FILE_SERVER)
+    if kind == "local":
+        return LocalDirStorage(LOCAL_STORE_DIR, FILE_SERVER)
+    if kind == "memory":
+        return MemoryStorage()
+    raise ValueError(f"unknown RESULT_STORAGE: {kind}")
+
+
+storage = make_storage(RESULT_STORAGE)
+
+
+async def result_url(result, output_format="png") -> str:
+    # 結果画像の URL を返す．結果キャッシュにヒットした画像も毎回保存し直す
+    # （ファイルサーバは保存期間・合計サイズの上限で古いファイルを削除するので，以前の URL は消えていることがある．
+    # 保存先はどれも内容から ID を決めるので，同じ画像は同じ URL になり，保存期間も延びる）
+    with timed("upload", result.get("timings")):
+        return await storage.put(result["buffer"].getvalue(), output_format)
+
+
+# ---------- ジョブストア ----------
+class JobStore:
+    # 非同期ジョブを SQLite に保存する（再起動しても待ち中のジョブは失われない）．
+    # 状態は queued -> running -> succeeded / failed / cancelled と遷移する．
+    # bearer_token はファイルに残さない（呼び出し側がメモリ上で持つ）
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    params TEXT NOT NULL,
+                    input_file BLOB,
+                    input_filename TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created_at)")
+
+    def add(self, params, priority=0, input_file=None, input_filename=None) -> str:
+        job_id = uuid.uuid4().hex
+        params = {k: v for k, v in params.items() if k != "bearer_token"}
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, priority, params, input_file, input_filename, created_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, priority, json.dumps(params), input_file, input_filename, time.time()),
+            )
+        return job_id
+
+    def requeue_running(self) -> int:
+        # 前回の実行中に停止したジョブを待ちに戻す
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'"
+            ).rowcount
+
+    def claim(self):
+        # 優先度が最も高く，最も古い待ちジョブを running にして返す
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                               (time.time(), row["id"]))
+            return dict(row)
+
+    def finish(self, job_id, status, result=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, input_file = NULL WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id),
+            )
+
+    def cancel_queued(self, job_id) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ?, input_file = NULL "
+                "WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            ).rowcount > 0
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, priority, result, error, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+# lifespan で開く（インポートしただけではファイルを作らない）
+job_store: JobStore = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, job_store
+    http_client = _make_http_client()
+    executor.start()
+    # 起動はすぐに完了させ，PRELOAD_MODES のパイプラインはバックグラウンドで読み込む
+    # （ワーカープールでは各ワーカーが担当モードを読み込む）
+    if PRELOAD_MODES and pool is None:
+        threading.Thread(target=registry.preload, args=(PRELOAD_MODES,), name="preload", daemon=True).start()
+    job_store = JobStore(JOB_DB_PATH)
+    requeued = job_store.requeue_running()
+    if requeued:
+        logger.info("requeued %d interrupted jobs", requeued)
+    job_tasks = [asyncio.create_task(job_worker()) for _ in range(JOB_WORKERS)]
+    yield
+    # 停止時に実行中だったジョブは running のまま残し，次回起動時に待ちへ戻す
+    stopping.set()
+    for task in job_tasks:
+        task.cancel()
+    await http_client.aclose()
+    if pool is not None:
+        await asyncio.to_thread(pool.stop)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_request_seconds(request: Request, call_next):
+    # ルートのパステンプレート（/jobs/{job_id} など）ごとに所要時間を記録する
+    start = time.monotonic()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(request.method, route.path if route else "unmatched",
+                           response.status_code).observe(time.monotonic() - start)
+    return response
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(
+        {"error": "inference queue is full", "queue": executor.stats()},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+class InvalidInputError(Exception):
+    pass
+
+
+@app.exception_handler(InvalidInputError)
+async def invalid_input_handler(request: Request, exc: InvalidInputError):
+    return JSONResponse({"error": str(exc)}, status_code=400)
+
+
+@app.exception_handler(InputTooLargeError)
+async def input_too_large_handler(request: Request, exc: InputTooLargeError):
+    return JSONResponse({"error": f"input image exceeds {MAX_INPUT_IMAGE_BYTES} bytes"}, status_code=413)
 
 
 def detect_mode(input_image_url, prompt, init_image):
@@ -151,19 +1110,536 @@ def get_generator(seed: int | None, i: int = 0):
     return torch.Generator().manual_seed(gen_seed), gen_seed
 
 
+# ---------- 進捗・プレビュー ----------
+# Flux の潜在変数（16ch）から RGB への線形近似（VAE デコードの代わりにプレビューに使う）
+FLUX_LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+FLUX_LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+
+
+class ProgressSink:
+    # 推論ワーカーのスレッドから，リクエスト側のイベントループのキューへ進捗イベントを送る．
+    # preview_every > 0 なら，そのステップごとに低解像度プレビューも送る（最大 max_previews 枚）．
+    # admitted は推論キューに受け付けられたら（全件が結果キャッシュにヒットして推論しない場合は完了時に）立つ
+    def __init__(self, loop, queue, preview_every=0, max_previews=None):
+        self.loop = loop
+        self.queue = queue
+        self.preview_every = preview_every
+        self.max_previews = max_previews
+        self.admitted = asyncio.Event()
+        self._previews = collections.Counter()  # 画像 index -> 送ったプレビュー数
+
+    def wants_preview(self, index, step, total) -> bool:
+        if self.preview_every <= 0 or step >= total:
+            return False  # 最終ステップは本画像が届くので不要
+        if self.max_previews is not None and self._previews[index] >= self.max_previews:
+            return False
+        return step % self.preview_every == 0
+
+    def send(self, event: dict):
+        if event["type"] == "preview":
+            event["preview_index"] = self._previews[event["index"]]
+            self._previews[event["index"]] += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+
+@torch.no_grad()
+def _latent_previews(pipe, latents, width, height):
+    # パックされた潜在変数を展開し，線形射影で RGB にする（解像度は出力の 1/8）
+    latents = pipe._unpack_latents(latents, height, width, pipe.vae_scale_factor).float()
+    factors = torch.tensor(FLUX_LATENT_RGB_FACTORS, device=latents.device)
+    bias = torch.tensor(FLUX_LATENT_RGB_BIAS, device=latents.device)
+    rgb = torch.einsum("bchw,cr->bhwr", latents, factors) + bias
+    rgb = ((rgb.clamp(-1, 1) + 1) * 127.5).to(torch.uint8).cpu().numpy()
+    return [Image.fromarray(a) for a in rgb]
+
+
+def _preview_event(index, step, total, img) -> dict:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=70)
+    return {
+        "type": "preview", "index": index, "step": step, "total": total,
+        "width": img.width, "height": img.height,
+        "b64_jpeg": base64.b64encode(buf.getvalue()).decode("utf-8"),
+    }
+
+
 # ---------- 共通処理 ----------
-async def run_pipeline(input_image_url, prompt, bearer_token, seed, width, height,
-                       guidance_scale, num_inference_steps, input_file: UploadFile = None, i: int = 0):
+def _batch_key(pipeline_mode, guidance_scale, num_inference_steps, width, height, init_image):
+    # この key が一致する仕事同士だけが同じパイプライン呼び出しにまとめられる．
+    # edit は入力画像をそのままバッチにするので，入力画像サイズも揃える必要がある．
+    image_size = init_image.size if pipeline_mode == "edit" else None
+    return (pipeline_mode, width, height, num_inference_steps, guidance_scale, image_size)
+
+
+def _batch_limit(key):
+    # 解像度に応じて 1 回の呼び出しでまとめる枚数を制限する（メモリ使用量はほぼ画素数に比例）
+    pipeline_mode, width, height = key[:3]
+    return max(1, min(BATCH_MAX_SIZE, BATCH_MAX_PIXELS // (width * height)))
+
+
+@torch.no_grad()
+def _encode_prompts(pipeline_mode, pipe, prompts):
+    # 同じプロンプトのテキストエンコード（CLIP / T5）はバッチ内で 1 回だけ行い，結果は prompt_cache に残す．
+    # キャッシュにヒットすればテキストエンコーダ（CPU オフロード時はその転送も）を丸ごと省ける
+    model = (PIPELINE_SPECS[pipeline_mode]["base_model"], json.dumps(MODEL_INFO[pipeline_mode]["loras"]))
+    device = pipe._execution_device
+    encoded = {}
+    for prompt in dict.fromkeys(prompts):
+        cached = prompt_cache.get((model, prompt))
+        if cached is None:
+            prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(prompt=prompt, prompt_2=None)
+            cached = (prompt_embeds.cpu(), pooled_prompt_embeds.cpu())
+            prompt_cache.put((model, prompt), cached, _tensor_bytes(*cached))
+        encoded[prompt] = cached
+    prompt_embeds = torch.cat([encoded[p][0] for p in prompts]).to(device)
+    pooled_prompt_embeds = torch.cat([encoded[p][1] for p in prompts]).to(device)
+    return prompt_embeds, pooled_prompt_embeds
+
+
+def _unique_images(payloads):
+    # 入力画像のハッシュで重複を除き，(ハッシュ -> 画像, 各仕事の行番号) を返す
+    images = {p["image_hash"]: p["init_image"] for p in payloads}
+    rows = [list(images).index(p["image_hash"]) for p in payloads]
+    return images, rows
+
+
+@torch.no_grad()
+def _redux_embeds(pipe_prior_redux, images):
+    # 入力画像ごとの Redux prior の出力を返す．redux_cache にあれば画像エンコーダを実行しない
+    model = PIPELINE_SPECS["variation"]["prior_model"]
+    embeds = {digest: redux_cache.get((model, digest)) for digest in images}
+    misses = [digest for digest, cached in embeds.items() if cached is None]
+    if misses:
+        output = pipe_prior_redux([images[digest] for digest in misses])
+        for i, digest in enumerate(misses):
+            cached = (output.prompt_embeds[i:i + 1].cpu(), output.pooled_prompt_embeds[i:i + 1].cpu())
+            redux_cache.put((model, digest), cached, _tensor_bytes(*cached))
+            embeds[digest] = cached
+    return [embeds[digest] for digest in images]
+
+
+def _step_callback(is_cancelled, payloads, width, height, marks):
+    # デノイズの各ステップの終わりに呼ばれる．バッチ全体がキャンセルされていれば打ち切り，
+    # 進捗の送り先（payload["progress"]）があれば進捗とプレビューを送る．
+    # 最後のステップの終了時刻を marks["last_step"] に残す（以降が VAE デコード）
+    def callback(pipe, step, timestep, callback_kwargs):
+        if is_cancelled():
+            raise InferenceCancelled()
+        total = pipe._num_timesteps
+        previews = None
+        for i, payload in enumerate(payloads):
+            sink = payload.get("progress")
+            if sink is None:
+                continue
+            sink.send({"type": "progress", "index": payload["index"], "step": step + 1, "total": total})
+            if sink.wants_preview(payload["index"], step + 1, total):
+                if previews is None:
+                    previews = _latent_previews(pipe, callback_kwargs["latents"], width, height)
+                sink.send(_preview_event(payload["index"], step + 1, total, previews[i]))
+        marks["last_step"] = time.monotonic()
+        return callback_kwargs
+    return callback
+
+
+def _add_batch_timings(payloads, timings):
+    # バッチの段階ごとの所要時間を各リクエストの timings に足し込む．
+    # n 枚が複数のチャンク（バッチ）に分かれても合計になるよう上書きせずに加算し，
+    # 同じリクエストの画像が 1 つのバッチに複数あっても 1 回だけ数える
+    for request_timings in {id(p["timings"]): p["timings"] for p in payloads}.values():
+        for stage, seconds in timings.items():
+            request_timings[stage] = request_timings.get(stage, 0.0) + seconds
+
+
+def _infer_batch(key, payloads, is_cancelled=lambda: False):
+    # 推論ワーカーのスレッドで実行される．payloads 1件につき 1 枚の画像を返す．
+    # 段階ごとの所要時間はバッチ単位で計測し，各 payload の "timings" にも書き込む
+    pipeline_mode, width, height, num_inference_steps, guidance_scale, _ = key
+    start = time.monotonic()
+    for p in payloads:
+        STAGE_SECONDS.labels("queue_wait").observe(start - p["submitted_at"])
+    BATCH_SIZE.observe(len(payloads))
+    timings = {}
+    prompts = [p["prompt"] for p in payloads]
+    generators = [p["generator"] for p in payloads]
+    marks = {}
+    callback = _step_callback(is_cancelled, payloads, width, height, marks)
+    with registry.use(pipeline_mode) as (pipe, pipe_prior_redux):
+        timings["pipeline_acquire"] = time.monotonic() - start
+        if pipeline_mode == "variation":
+            # Redux prior は入力画像ごとに 1 回だけ実行し，埋め込みを画像枚数分に並べる
+            images, rows = _unique_images(payloads)
+            with timed("redux", timings):
+                embeds = _redux_embeds(pipe_prior_redux, images)
+            device = pipe._execution_device
+            kwargs = {"prompt_embeds": torch.cat([embeds[r][0] for r in rows]).to(device),
+                      "pooled_prompt_embeds": torch.cat([embeds[r][1] for r in rows]).to(device)}
+        elif pipeline_mode == "edit":
+            with timed("text_encode", timings):
+                prompt_embeds, pooled_prompt_embeds = _encode_prompts(pipeline_mode, pipe, prompts)
+            images, rows = _unique_images(payloads)
+            images = list(images.values())
+            # 入力画像が 1 枚だけならパイプライン内で VAE エンコード結果が枚数分に複製される
+            image = images[0] if len(images) == 1 else [images[r] for r in rows]
+            kwargs = {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds, "image": image}
+        else:
+            with timed("text_encode", timings):
+                prompt_embeds, pooled_prompt_embeds = _encode_prompts(pipeline_mode, pipe, prompts)
+            kwargs = {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds}
+        # 最後のステップのコールバックまでをデノイズ，そこからパイプラインが返るまでを VAE デコードとみなす
+        denoise_start = time.monotonic()
+        result = pipe(generator=generators, guidance_scale=guidance_scale,
+                      num_inference_steps=num_inference_steps, width=width, height=height,
+                      callback_on_step_end=callback, **kwargs)
+        end = time.monotonic()
+        last_step = marks.get("last_step", end)
+        timings["denoise"] = last_step - denoise_start
+        timings["vae_decode"] = end - last_step
+    for stage in ("pipeline_acquire", "denoise", "vae_decode"):
+        STAGE_SECONDS.labels(stage).observe(timings[stage])
+    update_memory_metrics()
+    for p in payloads:
+        p["timings"]["queue_wait"] = max(p["timings"].get("queue_wait", 0.0), start - p["submitted_at"])
+    _add_batch_timings(payloads, timings)
+    return result.images
+
+
+# ---------- 推論ワーカープール ----------
+# INFERENCE_WORKERS を指定すると，デバイスごとの子プロセスが推論する（このプロセスはルーティングのみ）．
+# 子プロセスごとに InferenceExecutor（キュー・マイクロバッチ）を持ち，その run_batch が
+# バッチをパイプで子プロセスへ送る．結果画像は pickle せず共有メモリ経由で受け取る
+class _PipeSink(ProgressSink):
+    # 子プロセス側の進捗の送り先．イベントは親プロセスへ送り，親が本来の ProgressSink に渡す
+    def __init__(self, conn, item, preview_every, max_previews):
+        super().__init__(None, None, preview_every, max_previews)
+        self.conn = conn
+        self.item = item
+
+    def send(self, event: dict):
+        if event["type"] == "preview":
+            self._previews[event["index"]] += 1
+        self.conn.send(("event", self.item, event))
+
+
+class _SharedImageBuffer:
+    # 結果画像（RGB の生データ）を並べて置く共有メモリ．子プロセスが作成・拡張し，親は読むだけ．
+    # 親は次のバッチを送る前に読み終えるので，同じ領域を使い回せる
+    def __init__(self):
+        self.shm = None
+
+    def write(self, images):
+        arrays = [np.ascontiguousarray(np.asarray(img.convert("RGB"))) for img in images]
+        total = sum(a.nbytes for a in arrays)
+        if self.shm is None or self.shm.size < total:
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(total, 1))
+        layout, offset = [], 0
+        for a in arrays:
+            self.shm.buf[offset:offset + a.nbytes] = a.reshape(-1).data
+            layout.append((a.shape[1], a.shape[0], offset))
+            offset += a.nbytes
+        return self.shm.name, layout
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def _pool_worker_main(device, modes, conn, cancel):
+    # 子プロセスの本体．CUDA_VISIBLE_DEVICES は親が起動時に設定済み
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [{device}] %(message)s")
+    logger.setLevel(logging.INFO)
+    buffer = _SharedImageBuffer()
+    active = None
+    registry.preload([m for m in PRELOAD_MODES if m in modes])
+    conn.send(("status", registry.warm_modes(), active))
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            _, key, payloads = message
+            cancel_flag = cancel.is_set
+            for j, p in enumerate(payloads):
+                p["generator"] = torch.Generator().manual_seed(p.pop("seed"))
+                p["timings"] = {}
+                progress = p.pop("progress")
+                p["progress"] = _PipeSink(conn, j, *progress) if progress else None
+            try:
+                images = _infer_batch(key, payloads, cancel_flag)
+                name, layout = buffer.write(images)
+            except Exception as e:
+                try:
+                    conn.send(("error", e))
+                except Exception:
+                    conn.send(("error", RuntimeError(_error_message(e))))
+                continue
+            active = key[0]
+            peak = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+            conn.send(("done", name, layout, [p["timings"] for p in payloads], peak))
+            conn.send(("status", registry.warm_modes(), active))
+    finally:
+        buffer.close()
 
-    init_image = None
+
+class _PoolWorker:
+    # 子プロセス 1 つ分（親プロセス側）
+    def __init__(self, ctx, device, modes):
+        self.ctx = ctx
+        self.device = device
+        self.modes = modes
+        self.warm = set()      # 子プロセスで読み込み済みのモード
+        self.active = None     # 最後に実行したモード（LoRA アダプタがそのモードの組になっている）
+        self.process = None
+        self._shm = None
+        self._replies = None
+        self.executor = InferenceExecutor(self._run_batch, MAX_QUEUE_SIZE, _batch_limit, BATCH_MAX_WAIT_MS / 1000)
+
+    def start(self):
+        self.cancel = self.ctx.Event()
+        self.conn, child_conn = self.ctx.Pipe()
+        # 子プロセスからは担当の GPU だけが cuda:0 として見えるようにする（cpu なら GPU を使わない）
+        visible = self.device.split(":", 1)[1] if self.device.startswith("cuda:") else ""
+        saved = os.environ.get("CUDA_VISIBLE_DEVICES")
+        os.environ["CUDA_VISIBLE_DEVICES"] = visible
+        try:
+            self.process = self.ctx.Process(target=_pool_worker_main, args=(self.device, self.modes, child_conn,
+                                            self.cancel), name=f"inference-{self.device}", daemon=True)
+            self.process.start()
+        finally:
+            if saved is None:
+                os.environ.pop("CUDA_VISIBLE_DEVICES", None)
+            else:
+                os.environ["CUDA_VISIBLE_DEVICES"] = saved
+        child_conn.close()
+        # 返信のキューは子プロセスごとに作り直す（落ちた子プロセスの終了通知が次のバッチに混ざらないように）
+        self._replies = queue_module.Queue()
+        threading.Thread(target=self._reader, args=(self.conn, self._replies), name=f"reader-{self.device}", daemon=True).start()
+        self.executor.start()
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.conn.send(None)
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+
+    def _reader(self, conn, replies):
+        # 子プロセスからのメッセージを受け取る．状態の通知はここで反映し，それ以外は推論中のバッチへ渡す
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                replies.put(("error", RuntimeError(f"inference worker {self.device} exited")))
+                return
+            if message[0] == "status":
+                self.warm, self.active = set(message[1]), message[2]
+            else:
+                replies.put(message)
+
+    def _images(self, name, layout):
+        if self._shm is None or self._shm.name != name:
+            if self._shm is not None:
+                self._shm.close()
+            self._shm = shared_memory.SharedMemory(name=name)
+        return [Image.frombytes("RGB", (w, h), self._shm.buf[offset:offset + w * h * 3].tobytes())
+                for w, h, offset in layout]
+
+    def _run_batch(self, key, payloads, is_cancelled):
+        # この InferenceExecutor のスレッドで実行される．子プロセスが落ちていれば起動し直す
+        if not self.process.is_alive():
+            logger.warning("restarting inference worker %s", self.device)
+            self.warm, self.active = set(), None
+            self.start()
+        self.cancel.clear()
+        remote = []
+        for p in payloads:
+            sink = p.get("progress")
+            remote.append({
+                "prompt": p["prompt"], "init_image": p["init_image"], "image_hash": p["image_hash"],
+                "seed": p["seed"], "index": p["index"], "submitted_at": p["submitted_at"],
+                "progress": (sink.preview_every, sink.max_previews) if sink else None,
+            })
+        self.conn.send(("batch", key, remote))
+        while True:
+            try:
+                message = self._replies.get(timeout=0.1)
+            except queue_module.Empty:
+                if is_cancelled():
+                    self.cancel.set()  # 子プロセスはデノイズのステップの切れ目で打ち切る
+                continue
+            if message[0] == "event":
+                payloads[message[1]]["progress"].send(message[2])
+            elif message[0] == "error":
+                raise message[1]
+            else:
+                _, name, layout, timings, peak = message
+                break
+        # 子プロセスのメトリクスはこのプロセスから見えないので，受け取った値で記録し直す
+        BATCH_SIZE.observe(len(payloads))
+        for stage, seconds in timings[0].items():
+            if stage != "queue_wait":
+                STAGE_SECONDS.labels(stage).observe(seconds)
+        for p, t in zip(payloads, timings):
+            STAGE_SECONDS.labels("queue_wait").observe(t["queue_wait"])
+            p["timings"]["queue_wait"] = max(p["timings"].get("queue_wait", 0.0), t["queue_wait"])
+        _add_batch_timings(payloads, {stage: s for stage, s in timings[0].items() if stage != "queue_wait"})
+        if peak is not None:
+            GPU_PEAK_BYTES.labels(self.device).set(peak)
+        return self._images(name, layout)
+
+    def stats(self) -> dict:
+        return {
+            "device": self.device,
+            "modes": self.modes,
+            "pid": self.process.pid if self.process else None,
+            "alive": bool(self.process and self.process.is_alive()),
+            "warm": sorted(self.warm),
+            "active": self.active,
+            **self.executor.stats(),
+        }
+
+
+class WorkerPool:
+    # InferenceExecutor と同じインタフェース（start / submit / stats）で，仕事をワーカーへ振り分ける．
+    # 担当モードのワーカーのうち，直前に同じモードを実行した（LoRA の切り替えが要らない）もの，
+    # モードが読み込み済みのもの，の順に優先し，同順位ならキューの浅いものを選ぶ．
+    # ただしキュー深さが WORKER_AFFINITY_DEPTH 以上のワーカーは優先せず，空いているものへ回す
+    def __init__(self, specs):
+        ctx = multiprocessing.get_context("spawn")  # CUDA を使う子プロセスは fork できない
+        self.workers = []
+        for spec in specs:
+            device, _, modes = spec.partition("=")
+            modes = [m.strip() for m in modes.split(",") if m.strip()] or list(PIPELINE_SPECS)
+            self.workers.append(_PoolWorker(ctx, device.strip(), modes))
+
+    def start(self):
+        for worker in self.workers:
+            if worker.process is None:
+                worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def _route(self, mode):
+        candidates = [w for w in self.workers if mode in w.modes]
+        if not candidates:
+            raise RuntimeError(f"no inference worker serves {mode}")
+
+        def score(worker):
+            depth = worker.executor.stats()["depth"]
+            if depth >= WORKER_AFFINITY_DEPTH:
+                return 2, depth
+            if worker.active == mode:
+                return 0, depth
+            return (1 if mode in worker.warm else 2), depth
+
+        return min(candidates, key=score)
+
+    def submit(self, key, payloads):
+        return self._route(key[0]).executor.submit(key, payloads)
+
+    def warm_modes(self) -> list:
+        return [mode for mode in PIPELINE_SPECS if any(mode in w.warm for w in self.workers)]
+
+    def stats(self) -> dict:
+        workers = [w.stats() for w in self.workers]
+        return {
+            "depth": sum(w["depth"] for w in workers),
+            "pending": sum(w["pending"] for w in workers),
+            "running": sum(w["running"] for w in workers),
+            "max_queue_size": sum(w["max_queue_size"] for w in workers),
+            "workers": workers,
+        }
+
+
+pool = WorkerPool(INFERENCE_WORKERS) if INFERENCE_WORKERS else None
+executor = pool or InferenceExecutor(_infer_batch, MAX_QUEUE_SIZE, _batch_limit, BATCH_MAX_WAIT_MS / 1000)
+
+
+def encode_image(img, output_format="png", output_compression=None):
+    # 画像をエンコードして (バッファ, 所要秒数) を返す（イベントループ外のスレッドで呼ぶ）．
+    # output_compression は OpenAI Image API と同じく 0〜100 で，jpeg / webp の品質として使う
+    start = time.monotonic()
+    pil_format = OUTPUT_FORMATS[output_format][0]
+    if output_format == "png":
+        options = {"compress_level": PNG_COMPRESS_LEVEL}
+    else:
+        options = {"quality": 100 if output_compression is None else output_compression}
+    out_buf = io.BytesIO()
+    img.save(out_buf, format=pil_format, **options)
+    out_buf.seek(0)
+    return out_buf, time.monotonic() - start
+
+
+def invalid_output_options(output_format, output_compression):
+    # 出力形式の指定が不正ならエラーメッセージを返す
+    if output_format not in OUTPUT_FORMATS:
+        return f"output_format must be one of {', '.join(OUTPUT_FORMATS)}"
+    if output_compression is not None and not 0 <= output_compression <= 100:
+        return "output_compression must be between 0 and 100"
+    return None
+
+
+def invalid_n(n):
+    # 生成枚数の指定が不正ならエラーメッセージを返す
+    if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= MAX_N:
+        return f"n must be an integer between 1 and {MAX_N}"
+    return None
+
+
+def invalid_partial_images(partial_images):
+    # ストリーミングのプレビュー枚数の指定が不正ならエラーメッセージを返す（OpenAI と同じ 0〜3）
+    if not isinstance(partial_images, int) or isinstance(partial_images, bool) or not 0 <= partial_images <= 3:
+        return "partial_images must be an integer between 0 and 3"
+    return None
+
+
+async def run_pipeline(input_image_url, prompt, bearer_token, seed, width, height,
+                       guidance_scale, num_inference_steps, input_file: UploadFile = None, n: int = 1,
+                       output_format: str = "png", output_compression: int = None,
+                       progress: ProgressSink = None):
+    # n 枚を生成し，(結果のリスト, 入力画像情報) を返す（入力不正なら None, None）．
+    # 結果は {"image", "buffer"（エンコード済み）, "seed", "width", "height", "encode_seconds",
+    # "cache_hit", "cache_key", "timings"} の dict（結果キャッシュにヒットした場合 "image" は None）．
+    # "timings" は段階ごとの所要時間（秒）で，リクエスト内の結果で共有される．
+    # progress を渡すとデノイズの進捗（とプレビュー）がそこへ送られる．
+    # 入力画像の取得・デコード・テキストエンコード・Redux prior はリクエストあたり 1 回だけ行われる
+    error = invalid_n(n)
+    if error:
+        raise InvalidInputError(error)
+    init_image = image_hash = None
+    timings = {}
+    input_info = {"source": None, "bearer_token": bool(bearer_token)}
     if input_file:
         data = await input_file.read()
-        init_image = Image.open(io.BytesIO(data)).convert("RGB")
+        with timed("decode", timings):
+            init_image, image_hash = _decode_image(data)
         input_image_url = None
+        input_info.update({"source": "file", "filename": input_file.filename})
 
     pipeline_mode = detect_mode(input_image_url, prompt, init_image)
     if pipeline_mode is None:
-        return None, None, None  # エラー扱い
+        return None, None  # エラー扱い
 
     # パラメータ設定
     if pipeline_mode == "variation":
@@ -176,69 +1652,166 @@ async def run_pipeline(input_image_url, prompt, bearer_token, seed, width, heigh
         guidance_scale = guidance_scale or DEFAULTS["generate"]["guidance_scale"]
         num_inference_steps = num_inference_steps or DEFAULTS["generate"]["num_inference_steps"]
 
-    generator, used_seed = get_generator(seed, i)
+    generators, used_seeds = zip(*[get_generator(seed, i) for i in range(n)])
 
-    if pipeline_mode == "variation":
-        if init_image is None:
-            async with httpx.AsyncClient(verify=False) as client:
-                resp = await client.get(input_image_url)
-                resp.raise_for_status()
-                init_image = Image.open(io.BytesIO(resp.content)).convert("RGB")
-        pipe_prior_output = pipe_prior_redux(init_image)
-        result = pipe_var(generator=generator, guidance_scale=guidance_scale,
-                          num_inference_steps=num_inference_steps,
-                          width=width or init_image.size[0], height=height or init_image.size[1],
-                          **pipe_prior_output)
-    elif pipeline_mode == "edit":
-        if init_image is None:
-            headers = {}
-            if bearer_token:
-                headers["Authorization"] = f"Bearer {bearer_token}"
-            async with httpx.AsyncClient(verify=False) as client:
-                resp = await client.get(input_image_url, headers=headers)
-                resp.raise_for_status()
-                init_image = Image.open(io.BytesIO(resp.content)).convert("RGB")
-                if width is None or height is None:
-                    width, height = init_image.size
-        result = pipe_edit(prompt=prompt, image=init_image, generator=generator,
-                           guidance_scale=guidance_scale, num_inference_steps=num_inference_steps,
-                           width=width or init_image.size[0], height=height or init_image.size[1])
-    else:
+    if pipeline_mode in ("variation", "edit") and init_image is None:
+        headers = {}
+        if pipeline_mode == "edit" and bearer_token:
+            headers["Authorization"] = f"Bearer {bearer_token}"
+        with timed("download", timings):
+            data = await fetch_image_bytes(input_image_url, headers)
+        with timed("decode", timings):
+            init_image, image_hash = _decode_image(data)
+        input_info.update({"source": "url", "url": input_image_url})
+    if init_image is not None:
+        input_info.update({"original_width": init_image.width, "original_height": init_image.height})
+
+    if pipeline_mode == "generate":
         width = width or 1024
         height = height or 1024
-        result = pipe_gen(prompt=prompt, generator=generator, guidance_scale=guidance_scale,
-                          num_inference_steps=num_inference_steps, width=width, height=height)
+    else:
+        width = width or init_image.size[0]
+        height = height or init_image.size[1]
+
+    # seed が指定されていれば，GPU を使う前に結果キャッシュを引く（seed なしは毎回結果が違うので使わない）
+    cache_keys = [None] * n
+    cached = [None] * n
+    if seed is not None and result_cache is not None:
+        cache_keys = [
+            _result_key(pipeline_mode, prompt, used_seed, width, height, guidance_scale, num_inference_steps,
+                        image_hash, output_format, output_compression)
+            for used_seed in used_seeds
+        ]
+        with timed("cache_lookup", timings):
+            cached = await asyncio.gather(*[asyncio.to_thread(result_cache.get, key) for key in cache_keys])
+    misses = [i for i in range(n) if cached[i] is None]
+
+    # 推論は専用ワーカーで実行し，イベントループは他のリクエストを処理し続ける
+    processed_imgs = []
+    if misses:
+        futures = executor.submit(
+            _batch_key(pipeline_mode, guidance_scale, num_inference_steps, width, height, init_image),
+            [{"prompt": prompt, "init_image": init_image, "image_hash": image_hash, "generator": generators[i],
+              "seed": used_seeds[i], "index": i, "progress": progress, "timings": timings, "submitted_at": time.monotonic()}
+             for i in misses],
+        )
+        if progress is not None:
+            progress.admitted.set()
+        with timed("inference", timings):
+            processed_imgs = await asyncio.gather(*futures)
+
+    # エンコードもイベントループ外で行う（並列に走るので，timings には最も遅いものを記録する）
+    encoded = await asyncio.gather(*[
+        asyncio.to_thread(encode_image, img, output_format, output_compression) for img in processed_imgs
+    ])
+    for _, encode_seconds in encoded:
+        STAGE_SECONDS.labels("encode").observe(encode_seconds)
+    if encoded:
+        timings["encode"] = max(encode_seconds for _, encode_seconds in encoded)
+    results = [None] * n
+    for i, processed_img, (out_buf, encode_seconds) in zip(misses, processed_imgs, encoded):
+        results[i] = {"image": processed_img, "buffer": out_buf, "seed": used_seeds[i],
+                      "width": processed_img.width, "height": processed_img.height,
+                      "encode_seconds": encode_seconds, "cache_hit": False, "cache_key": cache_keys[i],
+                      "timings": timings}
+        if cache_keys[i] is not None:
+            meta = {"seed": used_seeds[i], "width": processed_img.width, "height": processed_img.height}
+            await asyncio.to_thread(result_cache.put, cache_keys[i], out_buf.getvalue(), meta)
+    for i, hit in enumerate(cached):
+        if hit is not None:
+            data, meta = hit
+            results[i] = {"image": None, "buffer": io.BytesIO(data), "seed": used_seeds[i],
+                          "width": meta["width"], "height": meta["height"],
+                          "encode_seconds": 0.0, "cache_hit": True, "cache_key": cache_keys[i],
+                          "timings": timings}
+    IMAGES_TOTAL.labels(pipeline_mode, "miss").inc(len(misses))
+    IMAGES_TOTAL.labels(pipeline_mode, "hit").inc(n - len(misses))
+    return results, input_info
 
-    processed_img = result.images[0]
-    out_buf = io.BytesIO()
-    processed_img.save(out_buf, format="PNG")
-    out_buf.seek(0)
-    return processed_img, out_buf, used_seed
+
+async def _openai_data(results, response_format, output_format="png"):
+    # OpenAI Image API 形式の data 配列を作る
+    data = []
+    for result in results:
+        buf, used_seed = result["buffer"], result["seed"]
+        if response_format == "b64_json":
+            data.append({"b64_json": base64.b64encode(buf.getvalue()).decode("utf-8"), "seed": used_seed})
+        else:
+            data.append({"url": await result_url(result, output_format), "seed": used_seed})
+    return data
 
 
 # ---------- オリジナルエンドポイント ----------
-@app.post("/process")
-async def process_image(
-    input_image_url: str = Form(None),
-    prompt: str = Form(""),
-    bearer_token: str = Form(None),
-    seed: int = Form(None),
-    width: int = Form(None),
-    height: int = Form(None),
-    guidance_scale: float = Form(None),
-    num_inference_steps: int = Form(None),
-    input_file: UploadFile = File(None),
-):
+@app.get("/status")
+async def status():
+    return {
+        "queue": executor.stats(),
+        "pipelines": registry.stats(),
+        "components": registry.footprint(),
+        "jobs": job_store.counts(),
+        "caches": {
+            "prompt_embeds": prompt_cache.stats(),
+            "images": image_cache.stats(),
+            "redux": redux_cache.stats(),
+            "results": result_cache.stats() if result_cache is not None else None,
+        },
+    }
+
+
+@app.get("/ready")
+async def ready():
+    # PRELOAD_MODES のパイプラインがすべて読み込まれていれば 200，そうでなければ 503
+    warm = pool.warm_modes() if pool else registry.warm_modes()
+    body = {
+        "ready": all(mode in warm for mode in PRELOAD_MODES),
+        "warm": warm,
+        "loading": [] if pool else registry.stats()["loading"],
+        "preload": PRELOAD_MODES,
+    }
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus 形式のメトリクス
+    QUEUE_DEPTH.set(executor.stats()["depth"])
+    update_memory_metrics()
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+async def _process_with_retry(**params):
+    # 推論キューが満杯なら空くまで待って再投入する（非同期ジョブ・一括処理用）
+    while True:
+        try:
+            return await _process(**params)
+        except QueueFullError as e:
+            await asyncio.sleep(e.retry_after)
+            if params.get("input_file"):
+                params["input_file"].file.seek(0)
+
+
+async def _process(input_image_url, prompt, bearer_token, seed, width, height, guidance_scale,
+                   num_inference_steps, input_file=None, output_format="png", output_compression=None,
+                   progress=None):
+    # /process と非同期ジョブの共通処理．メタデータ（結果画像の URL or Base64 を含む）を返す．
+    # メタデータの timings は段階ごとの所要時間（秒）
+    start = time.monotonic()
+    error = invalid_output_options(output_format, output_compression)
+    if error:
+        raise InvalidInputError(error)
+
     # 実行
-    img, buf, used_seed = await run_pipeline(
+    results, input_info = await run_pipeline(
         input_image_url, prompt, bearer_token, seed,
-        width, height, guidance_scale, num_inference_steps, input_file
+        width, height, guidance_scale, num_inference_steps, input_file,
+        output_format=output_format, output_compression=output_compression, progress=progress,
     )
-    if img is None:
-        return JSONResponse({"error": "invalid input"}, status_code=400)
+    if results is None:
+        raise InvalidInputError("invalid input")
+    buf, used_seed = results[0]["buffer"], results[0]["seed"]
 
     # 出力画像サイズ
-    output_width, output_height = img.width, img.height
+    output_width, output_height = results[0]["width"], results[0]["height"]
 
     # 実行モードの判定
     pipeline_mode = detect_mode(input_image_url, prompt, input_file)
@@ -254,37 +1827,6 @@ async def process_image(
         gs = guidance_scale or DEFAULTS["variation"]["guidance_scale"]
         steps = num_inference_steps or DEFAULTS["variation"]["num_inference_steps"]
 
-    # 入力画像情報
-    input_info = {"source": None, "bearer_token": bool(bearer_token)}
-    if input_file:
-        input_file.file.seek(0)
-        orig_img = Image.open(input_file.file).convert("RGB")
-        input_info.update({
-            "source": "file",
-            "filename": input_file.filename,
-            "original_width": orig_img.width,
-            "original_height": orig_img.height
-        })
-    elif input_image_url:
-        try:
-            async with httpx.AsyncClient(verify=False) as client:
-                resp = await client.get(input_image_url)
-                resp.raise_for_status()
-                orig_img = Image.open(io.BytesIO(resp.content)).convert("RGB")
-            input_info.update({
-                "source": "url",
-                "url": input_image_url,
-                "original_width": orig_img.width,
-                "original_height": orig_img.height
-            })
-        except Exception:
-            input_info.update({
-                "source": "url",
-                "url": input_image_url,
-                "original_width": None,
-                "original_height": None
-            })
-
     # モデル情報
     model_info = {
         "model": MODEL_INFO[pipeline_mode]["base_model"],
@@ -302,20 +1844,40 @@ async def process_image(
         "width": output_width,
         "height": output_height,
         **model_info,
+        "output_format": output_format,
+        "output_compression": output_compression,
+        "encode_seconds": results[0]["encode_seconds"],
+        "cache_hit": results[0]["cache_hit"],
     }
 
-    if FILE_SERVER:
-        upload_url = f"{FILE_SERVER}/upload"
-        files = {"file": (f"{uuid.uuid4()}.png", buf, "image/png")}
-        async with httpx.AsyncClient(verify=False) as client:
-            up_resp = await client.post(upload_url, files=files)
-            up_resp.raise_for_status()
-            up_result = up_resp.json()
-        metadata["result_image_url"] = f"{FILE_SERVER}{up_result['url']}"
-        return metadata
+    if storage:
+        metadata["result_image_url"] = await result_url(results[0], output_format)
     else:
         metadata["result_image_base64"] = base64.b64encode(buf.getvalue()).decode("utf-8")
-        return metadata
+    metadata["timings"] = {**results[0]["timings"], "total": time.monotonic() - start}
+    return metadata
+
+
+@app.post("/process")
+async def process_image(
+    response: Response,
+    input_image_url: str = Form(None),
+    prompt: str = Form(""),
+    bearer_token: str = Form(None),
+    seed: int = Form(None),
+    width: int = Form(None),
+    height: int = Form(None),
+    guidance_scale: float = Form(None),
+    num_inference_steps: int = Form(None),
+    input_file: UploadFile = File(None),
+    output_format: str = Form("png"),
+    output_compression: int = Form(None),
+):
+    metadata = await _process(input_image_url, prompt, bearer_token, seed, width, height, guidance_scale,
+                              num_inference_steps, input_file, output_format, output_compression)
+    response.headers["Server-Timing"] = server_timing(metadata["timings"])
+    return metadata
+
 
 @app.post("/process/raw")
 async def process_image_raw(
@@ -328,103 +1890,527 @@ async def process_image_raw(
     guidance_scale: float = Form(None),
     num_inference_steps: int = Form(None),
     input_file: UploadFile = File(None),
+    output_format: str = Form("png"),
+    output_compression: int = Form(None),
 ):
-    img, buf, used_seed = await run_pipeline(input_image_url, prompt, bearer_token, seed, width, height,
-                                             guidance_scale, num_inference_steps, input_file)
-    if img is None:
+    start = time.monotonic()
+    error = invalid_output_options(output_format, output_compression)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    results, _ = await run_pipeline(input_image_url, prompt, bearer_token, seed, width, height,
+                                    guidance_scale, num_inference_steps, input_file,
+                                    output_format=output_format, output_compression=output_compression)
+    if results is None:
         return JSONResponse({"error": "invalid input"}, status_code=400)
-    return StreamingResponse(buf, media_type="image/png")
+    return StreamingResponse(results[0]["buffer"], media_type=OUTPUT_FORMATS[output_format][1],
+                             headers={"X-Encode-Seconds": f"{results[0]['encode_seconds']:.4f}",
+                                      "Server-Timing": server_timing(results[0]["timings"], start)})
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _error_message(exc: Exception) -> str:
+    if isinstance(exc, QueueFullError):
+        return f"inference queue is full (retry after {exc.retry_after}s)"
+    return str(exc) or exc.__class__.__name__
+
+
+async def _wait_admitted(task, sink):
+    # task が推論キューに受け付けられるか，その前に終わるまで待つ．
+    # キューが満杯（503 + Retry-After）や入力不正（400）など推論前のエラーは，
+    # SSE を始める前にここで送出して通常のエラー応答にする
+    waiter = asyncio.ensure_future(sink.admitted.wait())
+    try:
+        await asyncio.wait({waiter, task}, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        task.cancel()  # 待っている間にクライアントが切断した
+        raise
+    finally:
+        waiter.cancel()
+    if task.done() and not sink.admitted.is_set() and task.exception() is not None:
+        raise task.exception()
+
+
+async def _stream_events(task, queue, format_event):
+    # task（推論）の進捗イベントを format_event で SSE に変換して流し，最後に結果を流す．
+    # クライアントが切断したら task を取り消し，デノイズもステップの切れ目で打ち切られる
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                chunk = format_event(getter.result())
+                if chunk:
+                    yield chunk
+                continue
+            getter.cancel()
+            while not queue.empty():
+                chunk = format_event(queue.get_nowait())
+                if chunk:
+                    yield chunk
+            if task.exception() is not None:
+                yield _sse("error", {"error": _error_message(task.exception())})
+            else:
+                yield format_event({"type": "result", "result": task.result()})
+            break
+    finally:
+        task.cancel()
+
+
+@app.post("/process/stream")
+async def process_image_stream(
+    input_image_url: str = Form(None),
+    prompt: str = Form(""),
+    bearer_token: str = Form(None),
+    seed: int = Form(None),
+    width: int = Form(None),
+    height: int = Form(None),
+    guidance_scale: float = Form(None),
+    num_inference_steps: int = Form(None),
+    input_file: UploadFile = File(None),
+    output_format: str = Form("png"),
+    output_compression: int = Form(None),
+    preview_every: int = Form(0),
+):
+    # /process のストリーミング版（Server-Sent Events）．
+    # progress（ステップごと），preview（preview_every ステップごと），result（/process と同じ JSON）を送る
+    queue = asyncio.Queue()
+    sink = ProgressSink(asyncio.get_running_loop(), queue, preview_every)
+    task = asyncio.create_task(_process(
+        input_image_url, prompt, bearer_token, seed, width, height, guidance_scale,
+        num_inference_steps, input_file, output_format, output_compression, sink,
+    ))
+    await _wait_admitted(task, sink)
+
+    def format_event(event):
+        if event["type"] == "result":
+            return _sse("result", event["result"])
+        return _sse(event["type"], {k: v for k, v in event.items() if k != "type"})
+
+    return StreamingResponse(_stream_events(task, queue, format_event), media_type="text/event-stream")
+
+
+# ---------- 非同期ジョブ ----------
+job_wakeup = asyncio.Event()   # ジョブが投入されたら job_worker を起こす
+running_jobs = {}              # ジョブ ID -> 実行中の asyncio.Task
+cancel_requested = set()       # 取り出し直後（Task 作成前）にキャンセルされたジョブ ID
+job_tokens = {}                # ジョブ ID -> bearer_token（SQLite には保存せず，終わったら捨てる）
+stopping = asyncio.Event()     # サーバ停止中
+
+
+async def _run_job(job):
+    params = json.loads(job["params"])
+    # 再起動をまたいだジョブはトークンが失われているので，トークンなしで実行する
+    params["bearer_token"] = job_tokens.get(job["id"])
+    input_file = None
+    if job["input_file"] is not None:
+        input_file = UploadFile(filename=job["input_filename"], file=io.BytesIO(job["input_file"]))
+    try:
+        if job["id"] in cancel_requested:
+            raise asyncio.CancelledError()
+        metadata = await _process_with_retry(**params, input_file=input_file)
+    except asyncio.CancelledError:
+        if stopping.is_set():
+            raise
+        await asyncio.to_thread(job_store.finish, job["id"], "cancelled")
+    except Exception as e:
+        logger.exception("job %s failed", job["id"])
+        await asyncio.to_thread(job_store.finish, job["id"], "failed", None, str(e))
+    else:
+        await asyncio.to_thread(job_store.finish, job["id"], "succeeded", metadata)
+    finally:
+        cancel_requested.discard(job["id"])
+        job_tokens.pop(job["id"], None)
+
+
+async def job_worker():
+    # 待ちジョブを優先度順に取り出して実行する（JOB_WORKERS 個が並行に動く）
+    while True:
+        job = await asyncio.to_thread(job_store.claim)
+        if job is None:
+            job_wakeup.clear()
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        task = asyncio.create_task(_run_job(job))
+        running_jobs[job["id"]] = task
+        try:
+            await asyncio.wait([task])
+        finally:
+            running_jobs.pop(job["id"], None)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    input_image_url: str = Form(None),
+    prompt: str = Form(""),
+    bearer_token: str = Form(None),
+    seed: int = Form(None),
+    width: int = Form(None),
+    height: int = Form(None),
+    guidance_scale: float = Form(None),
+    num_inference_steps: int = Form(None),
+    input_file: UploadFile = File(None),
+    output_format: str = Form("png"),
+    output_compression: int = Form(None),
+    priority: int = Form(0),
+):
+    error = invalid_output_options(output_format, output_compression)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    params = {
+        "input_image_url": input_image_url,
+        "prompt": prompt,
+        "bearer_token": bearer_token,
+        "seed": seed,
+        "width": width,
+        "height": height,
+        "guidance_scale": guidance_scale,
+        "num_inference_steps": num_inference_steps,
+        "output_format": output_format,
+        "output_compression": output_compression,
+    }
+    data = await input_file.read() if input_file else None
+    job_id = await asyncio.to_thread(
+        job_store.add, params, priority, data, input_file.filename if input_file else None
+    )
+    if bearer_token:
+        job_tokens[job_id] = bearer_token
+    job_wakeup.set()
+    return {"id": job_id, "status": "queued", "priority": priority}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    return job
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    # 待ち中ならすぐに取り消し，実行中ならデノイズのステップの切れ目で打ち切る
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    if job["status"] == "queued" and await asyncio.to_thread(job_store.cancel_queued, job_id):
+        job_tokens.pop(job_id, None)
+        return {"id": job_id, "status": "cancelled"}
+    if job["status"] in ("queued", "running"):
+        task = running_jobs.get(job_id)
+        if task is not None:
+            task.cancel()
+        else:
+            cancel_requested.add(job_id)
+        return {"id": job_id, "status": "cancelling"}
+    return {"id": job_id, "status": job["status"]}
+
+
+# ---------- 一括処理 ----------
+# JSONL の 1 行が 1 件．/process と同じパラメータを持ち，入力画像は input_image_url か
+# input_image_base64 で渡す
+BULK_PARAMS = ["input_image_url", "prompt", "bearer_token", "seed", "width", "height",
+               "guidance_scale", "num_inference_steps", "output_format", "output_compression"]
+
+
+def parse_jsonl(text: str) -> list:
+    # (行番号, パラメータ) のリストを返す（空行は飛ばすが行番号は元のまま）．
+    # JSON オブジェクトでない行があれば ValueError（ストリーミングを始める前に 400 にするため）
+    items = []
+    for index, line in enumerate(text.splitlines()):
+        if line.strip():
+            params = json.loads(line)
+            if not isinstance(params, dict):
+                raise ValueError(f"line {index + 1}: expected a JSON object")
+            items.append((index, params))
+    return items
+
+
+def completed_indices(text: str) -> set:
+    # 以前の出力（NDJSON）から成功済みの行番号を集める（途中から再開するため）
+    done = set()
+    for line in text.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # 書き込み途中で止まった最後の行など
+        if isinstance(record, dict) and record.get("status") == "ok" and "index" in record:
+            done.add(record["index"])
+    return done
+
+
+def _bulk_sort_key(params):
+    # モード・解像度・ステップ数・guidance が同じものを並べて投入し，
+    # マイクロバッチを組みやすくしつつ LoRA アダプタやパイプラインの切り替えを減らす
+    has_input = params.get("input_image_url") or params.get("input_image_base64")
+    mode = detect_mode(has_input, params.get("prompt"), None) or ""
+    defaults = DEFAULTS.get(mode, {})
+    return (
+        mode,
+        params.get("width") or 0,
+        params.get("height") or 0,
+        params.get("num_inference_steps") or defaults.get("num_inference_steps", 0),
+        params.get("guidance_scale") or defaults.get("guidance_scale", 0),
+    )
+
+
+async def run_bulk(items, skip=()):
+    # items を並べ替えて投入し，終わった順に {"index", "status", ...} を返す．
+    # 行ごとに Task を作らず，BULK_CONCURRENCY 個のワーカーが並べ替えた順に 1 件ずつ取り出して実行する．
+    # 結果の受け渡しも BULK_CONCURRENCY 件までなので，読み手が遅ければワーカーも待つ
+    pending = sorted([(i, p) for i, p in items if i not in skip], key=lambda item: _bulk_sort_key(item[1]))
+    remaining = iter(pending)
+    done = asyncio.Queue(maxsize=BULK_CONCURRENCY)
+
+    async def run(index, item):
+        try:
+            params = {k: item.get(k) for k in BULK_PARAMS}
+            params["prompt"] = params["prompt"] or ""
+            params["output_format"] = params["output_format"] or "png"
+            if item.get("input_image_base64"):
+                data = base64.b64decode(item["input_image_base64"])
+                params["input_file"] = UploadFile(filename=f"line{index}", file=io.BytesIO(data))
+            metadata = await _process_with_retry(**params)
+        except Exception as e:
+            return {"index": index, "status": "error", "error": _error_message(e)}
+        return {"index": index, "status": "ok", **metadata}
+
+    async def worker():
+        for index, item in remaining:
+            await done.put(await run(index, item))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(BULK_CONCURRENCY, len(pending)))]
+    try:
+        for _ in range(len(pending)):
+            yield await done.get()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+@app.post("/v1/images/batch")
+async def openai_image_batch(request: Request):
+    # JSONL（リクエストボディそのもの，または multipart の file フィールド）を受け取り，
+    # 結果を終わった順に NDJSON で返す．multipart の completed フィールドに以前の出力を渡すと，
+    # 成功済みの行は飛ばして再開する
+    completed = set()
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None:
+            return JSONResponse({"error": "file is required"}, status_code=400)
+        text = (await upload.read()).decode("utf-8") if hasattr(upload, "read") else upload
+        if form.get("completed") is not None:
+            prev = form["completed"]
+            completed = completed_indices((await prev.read()).decode("utf-8") if hasattr(prev, "read") else prev)
+    else:
+        text = (await request.body()).decode("utf-8")
+    try:
+        items = parse_jsonl(text)
+    except ValueError as e:
+        return JSONResponse({"error": f"invalid JSONL: {e}"}, status_code=400)
+
+    async def lines():
+        async for record in run_bulk(items, completed):
+            yield json.dumps(record) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 # ---------- OpenAI Image API 互換エンドポイント ----------
 @app.post("/v1/images/generations")
-async def openai_image_generate(body: dict = Body(...)):
+async def openai_image_generate(response: Response, body: dict = Body(...)):
+    start = time.monotonic()
     prompt = body.get("prompt")
     n = body.get("n", 1)
     size = body.get("size", "1024x1024")
     response_format = body.get("response_format", "url")
     seed = body.get("seed")
+    output_format = body.get("output_format", "png")
+    output_compression = body.get("output_compression")
+    stream = body.get("stream", False)
+    partial_images = body.get("partial_images", 0)
     
     width, height = map(int, size.split("x"))
-    results = []
-    for i in range(n):
-        img, buf, used_seed = await run_pipeline(None, prompt, None, seed, width, height, None, None, None, i)
-        if img is None:
-            return JSONResponse({"error": "invalid input"}, status_code=400)
-        if response_format == "b64_json":
-            results.append({"b64_json": base64.b64encode(buf.getvalue()).decode("utf-8"), "seed": used_seed})
-        else:
-            if not FILE_SERVER:
-                return JSONResponse({"error": "FILE_SERVER not configured"}, status_code=500)
-            upload_url = f"{FILE_SERVER}/upload"
-            files = {"file": (f"{uuid.uuid4()}.png", buf, "image/png")}
-            async with httpx.AsyncClient(verify=False) as client:
-                up_resp = await client.post(upload_url, files=files)
-                up_resp.raise_for_status()
-                up_result = up_resp.json()
-            results.append({"url": f"{FILE_SERVER}{up_result['url']}", "seed": used_seed})
-    return {"created": int(time.time()), "data": results}
+    error = (invalid_output_options(output_format, output_compression) or invalid_n(n)
+             or invalid_partial_images(partial_images))
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    if stream:
+        return await _openai_generate_stream(prompt, n, size, seed, output_format, output_compression, partial_images)
+    if response_format != "b64_json" and not storage:
+        return JSONResponse({"error": "FILE_SERVER not configured"}, status_code=500)
+    results, _ = await run_pipeline(None, prompt, None, seed, width, height, None, None, None, n,
+                                    output_format, output_compression)
+    if results is None:
+        return JSONResponse({"error": "invalid input"}, status_code=400)
+    data = await _openai_data(results, response_format, output_format)
+    response.headers["Server-Timing"] = server_timing(results[0]["timings"], start)
+    return {"created": int(time.time()), "data": data}
+
+
+async def _openai_generate_stream(prompt, n, size, seed, output_format, output_compression, partial_images):
+    # stream=true のとき，OpenAI と同じ形式のイベント
+    # （image_generation.partial_image / image_generation.completed）を Server-Sent Events で返す．
+    # partial_images は潜在変数からの低解像度プレビュー（JPEG）
+    width, height = map(int, size.split("x"))
+    steps = DEFAULTS["generate"]["num_inference_steps"]
+    queue = asyncio.Queue()
+    preview_every = max(1, steps // (partial_images + 1)) if partial_images else 0
+    sink = ProgressSink(asyncio.get_running_loop(), queue, preview_every, partial_images)
+    task = asyncio.create_task(run_pipeline(None, prompt, None, seed, width, height, None, None, None, n,
+                                            output_format, output_compression, sink))
+    await _wait_admitted(task, sink)
+    if task.done() and task.result()[0] is None:
+        return JSONResponse({"error": "invalid input"}, status_code=400)
+    created = int(time.time())
+
+    def format_event(event):
+        if event["type"] == "preview":
+            name = "image_generation.partial_image"
+            return _sse(name, {
+                "type": name, "b64_json": event["b64_jpeg"], "created_at": created,
+                "size": f"{event['width']}x{event['height']}", "output_format": "jpeg",
+                "partial_image_index": event["preview_index"], "index": event["index"],
+            })
+        if event["type"] == "result":
+            results, _ = event["result"]
+            if results is None:
+                return _sse("error", {"error": "invalid input"})
+            name = "image_generation.completed"
+            return "".join(_sse(name, {
+                "type": name, "b64_json": base64.b64encode(r["buffer"].getvalue()).decode("utf-8"),
+                "created_at": created, "size": size, "output_format": output_format,
+                "index": i, "seed": r["seed"],
+            }) for i, r in enumerate(results))
+        return None  # 進捗イベントは OpenAI 形式にはないので送らない
+
+    return StreamingResponse(_stream_events(task, queue, format_event), media_type="text/event-stream")
 
 
 @app.post("/v1/images/edits")
 async def openai_image_edit(
+    response: Response,
     image: UploadFile = File(...),
     prompt: str = Form(...),
     n: int = Form(1),
     size: str = Form("1024x1024"),
     response_format: str = Form("url"),
     seed: int = Form(None),
+    output_format: str = Form("png"),
+    output_compression: int = Form(None),
 ):
+    start = time.monotonic()
     width, height = map(int, size.split("x"))
-    raw_bytes = await image.read()
-    results = []
-    for i in range(n):
-        img_file = UploadFile(filename=image.filename, file=io.BytesIO(raw_bytes))
-        img, buf, used_seed = await run_pipeline(None, prompt, None, seed, width, height, None, None, img_file, i)
-        if img is None:
-            return JSONResponse({"error": "invalid input"}, status_code=400)
-        if response_format == "b64_json":
-            results.append({"b64_json": base64.b64encode(buf.getvalue()).decode("utf-8"), "seed": used_seed})
-        else:
-            if not FILE_SERVER:
-                return JSONResponse({"error": "FILE_SERVER not configured"}, status_code=500)
-            upload_url = f"{FILE_SERVER}/upload"
-            files = {"file": (f"{uuid.uuid4()}.png", buf, "image/png")}
-            async with httpx.AsyncClient(verify=False) as client:
-                up_resp = await client.post(upload_url, files=files)
-                up_resp.raise_for_status()
-                up_result = up_resp.json()
-            results.append({"url": f"{FILE_SERVER}{up_result['url']}", "seed": used_seed})
-    return {"created": int(time.time()), "data": results}
+    error = invalid_output_options(output_format, output_compression) or invalid_n(n)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    if response_format != "b64_json" and not storage:
+        return JSONResponse({"error": "FILE_SERVER not configured"}, status_code=500)
+    results, _ = await run_pipeline(None, prompt, None, seed, width, height, None, None, image, n,
+                                    output_format, output_compression)
+    if results is None:
+        return JSONResponse({"error": "invalid input"}, status_code=400)
+    data = await _openai_data(results, response_format, output_format)
+    response.headers["Server-Timing"] = server_timing(results[0]["timings"], start)
+    return {"created": int(time.time()), "data": data}
 
 
 @app.post("/v1/images/variations")
 async def openai_image_variation(
+    response: Response,
     image: UploadFile = File(...),
     n: int = Form(1),
     size: str = Form("1024x1024"),
     response_format: str = Form("url"),
     seed: int = Form(None),
+    output_format: str = Form("png"),
+    output_compression: int = Form(None),
 ):
+    start = time.monotonic()
     width, height = map(int, size.split("x"))
-    raw_bytes = await image.read()
-    results = []
-    for i in range(n):
-        img_file = UploadFile(filename=image.filename, file=io.BytesIO(raw_bytes))
-        img, buf, used_seed = await run_pipeline(None, None, None, seed, width, height, None, None, img_file, i)
-        if img is None:
-            return JSONResponse({"error": "invalid input"}, status_code=400)
-        if response_format == "b64_json":
-            results.append({"b64_json": base64.b64encode(buf.getvalue()).decode("utf-8"), "seed": used_seed})
-        else:
-            if not FILE_SERVER:
-                return JSONResponse({"error": "FILE_SERVER not configured"}, status_code=500)
-            upload_url = f"{FILE_SERVER}/upload"
-            files = {"file": (f"{uuid.uuid4()}.png", buf, "image/png")}
-            async with httpx.AsyncClient(verify=False) as client:
-                up_resp = await client.post(upload_url, files=files)
-                up_resp.raise_for_status()
-                up_result = up_resp.json()
-            results.append({"url": f"{FILE_SERVER}{up_result['url']}", "seed": used_seed})
-    return {"created": int(time.time()), "data": results}
+    error = invalid_output_options(output_format, output_compression) or invalid_n(n)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    if response_format != "b64_json" and not storage:
+        return JSONResponse({"error": "FILE_SERVER not configured"}, status_code=500)
+    results, _ = await run_pipeline(None, None, None, seed, width, height, None, None, image, n,
+                                    output_format, output_compression)
+    if results is None:
+        return JSONResponse({"error": "invalid input"}, status_code=400)
+    data = await _openai_data(results, response_format, output_format)
+    response.headers["Server-Timing"] = server_timing(results[0]["timings"], start)
+    return {"created": int(time.time()), "data": data}
+
+
+# ---------- コマンドライン ----------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flux Imaging API utilities")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_cache = sub.add_parser("build-cache", help="量子化・LoRA 適用済みパイプラインのキャッシュを作成する")
+    p_cache.add_argument("--cache-dir", default=PIPELINE_CACHE_DIR, help="キャッシュ先（デフォルト: PIPELINE_CACHE_DIR）")
+    p_cache.add_argument("--modes", default=",".join(PIPELINE_SPECS), help="対象モード（カンマ区切り）")
+    p_batch = sub.add_parser("batch", help="JSONL ファイルを一括処理して結果を NDJSON に書く")
+    p_batch.add_argument("input", help="入力 JSONL ファイル（1 行 1 件，/process と同じパラメータ）")
+    p_batch.add_argument("--output", required=True, help="出力 NDJSON ファイル（既にあれば成功済みの行を飛ばして再開）")
+    p_batch.add_argument("--output-dir", default=None, help="結果画像を書き出すディレクトリ（指定時は Base64 の代わりにパスを出力）")
+    args = parser.parse_args(argv)
+
+    if args.command == "batch":
+        logging.basicConfig(level=logging.INFO)
+        return asyncio.run(_batch_cli(args.input, args.output, args.output_dir))
+
+    if args.command == "build-cache":
+        if not args.cache_dir:
+            parser.error("--cache-dir or PIPELINE_CACHE_DIR is required")
+        logging.basicConfig(level=logging.INFO)
+        logger.setLevel(logging.INFO)
+        builder = ComponentRegistry(cache_dir=args.cache_dir)
+        for mode in args.modes.split(","):
+            builder.load(mode.strip())
+        for key, seconds in builder.load_seconds.items():
+            print(f"{key[1]} ({key[0]}): {builder.load_sources[key]} {seconds:.1f}s")
+        return 0
+
+
+async def _batch_cli(input_path, output_path, output_dir=None):
+    global http_client
+    with open(input_path, encoding="utf-8") as f:
+        items = parse_jsonl(f.read())
+    skip = set()
+    if os.path.exists(output_path):
+        with open(output_path, encoding="utf-8") as f:
+            skip = completed_indices(f.read())
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    http_client = _make_http_client()
+    executor.start()
+    failed = 0
+    try:
+        with open(output_path, "a", encoding="utf-8") as out:
+            async for record in run_bulk(items, skip):
+                if output_dir and record.get("result_image_base64"):
+                    ext = OUTPUT_FORMATS[record["output_format"]][2]
+                    path = os.path.join(output_dir, f"{record['index']:06d}{ext}")
+                    with open(path, "wb") as img_file:
+                        img_file.write(base64.b64decode(record.pop("result_image_base64")))
+                    record["result_image_path"] = path
+                failed += record["status"] != "ok"
+                # 1 行ずつ書いて flush し，途中で止まってもそこから再開できるようにする
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+    finally:
+        await http_client.aclose()
+        if pool is not None:
+            pool.stop()
+    logger.info("batch finished: %d done, %d skipped, %d failed", len(items) - len(skip), len(skip), failed)
+    return 1 if failed else 0
+
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,220 @@
-import os, uuid, pathlib, datetime
+import os, re, pathlib, datetime, time, threading, sqlite3, asyncio, collections, hashlib, mimetypes, logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Depends
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from starlette.middleware.cors import CORSMiddleware
 from typing import Optional
  
+logger = logging.getLogger("uvicorn.error")
+ 
 TMP_DIR = "/tmp/imgtmp"
 os.makedirs(TMP_DIR, exist_ok=True)
  
 BEARER_TOKEN = os.environ.get("BEARER_TOKEN", "changeme-token")
  
-app = FastAPI(title="Image File Server")
+# アップロードの最大サイズ（超えたら 413）
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# multipart のヘッダや境界文字列の分として Content-Length に見込む余裕
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+ 
+# 保存期間と合計サイズの上限（0 で無制限）．GC_INTERVAL_SECONDS ごとに古いものから削除する
+FILE_TTL_HOURS = float(os.environ.get("FILE_TTL_HOURS", "168"))
+MAX_TOTAL_MB = float(os.environ.get("MAX_TOTAL_MB", "10240"))
+GC_INTERVAL_SECONDS = float(os.environ.get("GC_INTERVAL_SECONDS", "60"))
+ 
+# 他のプロセス（RESULT_STORAGE=local の Flux Imaging API）が直接書き込んだファイルは
+# INCOMING_DIR に同名の目印を置くので，INCOMING_POLL_SECONDS ごとに索引へ取り込む
+INCOMING_DIR = os.path.join(TMP_DIR, ".incoming")
+INCOMING_POLL_SECONDS = float(os.environ.get("INCOMING_POLL_SECONDS", "1"))
+ 
+# ファイル一覧（索引）の保存先（デフォルト: なし = 起動時にディレクトリを走査して作る）
+INDEX_DB_PATH = os.environ.get("INDEX_DB_PATH", None)
+ 
+# Prometheus 形式のメトリクス
+REQUEST_SECONDS = Histogram(
+    "file_server_http_request_seconds", "HTTP request duration", ["method", "route", "status"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+UPLOAD_BYTES = Counter("file_server_upload_bytes_total", "Bytes written by uploads")
+UPLOADS = Counter("file_server_uploads_total", "Uploaded files")
+DEDUPLICATED = Counter("file_server_deduplicated_total", "Uploads whose content was already stored")
+STORED_FILES = Gauge("file_server_stored_files", "Files currently stored")
+STORED_BYTES = Gauge("file_server_stored_bytes", "Bytes currently stored")
+GC_DELETED = Counter("file_server_gc_deleted_total", "Files deleted by the garbage collector", ["reason"])
+ 
+# ファイル ID は内容の sha256（先頭 32 桁）+ 拡張子．同じ内容は 1 度だけ保存される．
+# 保存先は ID の先頭 4 桁で 2 段に分ける（/tmp/imgtmp/ab/cd/abcd....png）．
+# 以前の UUID のファイル（/tmp/imgtmp 直下）もそのまま配信する
+FID_PATTERN = re.compile(r"^[0-9a-f]{32}(\.[a-z0-9]{1,5})?$")
+ 
+def file_path(fid):
+    # ID から保存先のパスを返す（ID として不正なら None）
+    if not FID_PATTERN.match(fid):
+        return None
+    path = os.path.join(TMP_DIR, fid[:2], fid[2:4], fid)
+    if not os.path.exists(path) and os.path.isfile(os.path.join(TMP_DIR, fid)):
+        return os.path.join(TMP_DIR, fid)
+    return path
+ 
+class FileIndex:
+    # 保存中のファイルの一覧（fid -> [アップロード時刻, サイズ, 最終参照時刻]）を最終参照の古い順に保持する．
+    # 最新のアップロードは別に覚えておくので /latest は O(1)，GC は先頭（長く参照されていないもの）から削除する．
+    # 参照時刻はメモリ上だけで更新し（ファイルへの書き込みはしない），SQLite には flush() でまとめて書く．
+    # db_path を指定すると，再起動時にディレクトリを走査せずに復元する
+    def __init__(self, directory, db_path=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._files = collections.OrderedDict()
+        self._latest = None
+        self._dirty = set()  # SQLite に未反映の参照時刻
+        self.total_bytes = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS files (fid TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL)")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(files)")]
+            if "accessed" not in columns:
+                self._db.execute("ALTER TABLE files ADD COLUMN accessed REAL")
+        rows = self._db.execute("SELECT fid, mtime, size, COALESCE(accessed, mtime) FROM files").fetchall() if self._db else []
+        if rows:
+            # 索引にあってもファイルが消えているもの（手動で削除した等）は除く
+            rows = [r for r in rows if file_path(r[0]) and os.path.isfile(file_path(r[0]))]
+        else:
+            rows = self._scan()
+            if self._db:
+                self._db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+        for fid, mtime, size, accessed in sorted(rows, key=lambda r: r[3]):
+            self._files[fid] = [mtime, size, accessed]
+            self.total_bytes += size
+            if self._latest is None or mtime >= self._files[self._latest][0]:
+                self._latest = fid
+ 
+    def _scan(self):
+        rows = []
+        for root, dirs, names in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]  # .incoming など
+            for name in names:
+                path = os.path.join(root, name)
+                if name.startswith(".tmp-"):
+                    if time.time() - os.path.getmtime(path) > 3600:
+                        os.remove(path)  # 書き込み途中で止まった一時ファイル
+                elif FID_PATTERN.match(name):
+                    st = os.stat(path)
+                    rows.append((name, st.st_mtime, st.st_size, st.st_mtime))
+        return rows
+ 
+    def add(self, fid, mtime, size):
+        # アップロードされたファイルを最新として登録する（同じ内容の再アップロードも最新になる）
+        with self._lock:
+            old = self._files.pop(fid, None)
+            if old:
+                self.total_bytes -= old[1]
+            self._files[fid] = [mtime, size, mtime]
+            self.total_bytes += size
+            self._latest = fid
+            self._dirty.discard(fid)
+            if self._db:
+                self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (fid, mtime, size, mtime))
+ 
+    def touch(self, fid, now):
+        # 参照されたファイルを GC の対象から遠ざける．索引にないファイル（他のプロセスが書いたもの）なら False
+        with self._lock:
+            entry = self._files.get(fid)
+            if entry is None:
+                return False
+            entry[2] = now
+            self._files.move_to_end(fid)
+            self._dirty.add(fid)
+            return True
+ 
+    def latest(self):
+        # (fid, アップロード時刻) を返す（ファイルがなければ None）
+        with self._lock:
+            if self._latest is None:
+                return None
+            return self._latest, self._files[self._latest][0]
+ 
+    def flush(self):
+        # メモリ上の参照時刻を SQLite に書く
+        with self._lock:
+            rows = [(self._files[fid][2], fid) for fid in self._dirty if fid in self._files]
+            self._dirty.clear()
+            if self._db and rows:
+                self._db.executemany("UPDATE files SET accessed = ? WHERE fid = ?", rows)
+ 
+    def collect(self, ttl_seconds, max_bytes):
+        # 期限切れ（最後の参照から ttl_seconds 経過）と合計サイズの超過分を，
+        # 長く参照されていない順に索引から外し，ファイルを削除する
+        now = time.time()
+        victims = []
+        with self._lock:
+            while self._files:
+                fid, (mtime, size, accessed) = next(iter(self._files.items()))
+                if ttl_seconds and now - accessed > ttl_seconds:
+                    reason = "ttl"
+                elif max_bytes and self.total_bytes > max_bytes:
+                    reason = "size"
+                else:
+                    break
+                del self._files[fid]
+                self.total_bytes -= size
+                victims.append((fid, reason))
+            if self._latest not in self._files:
+                self._latest = max(self._files, key=lambda f: self._files[f][0], default=None)
+            if self._db and victims:
+                self._db.executemany("DELETE FROM files WHERE fid = ?", [(fid,) for fid, _ in victims])
+        for fid, reason in victims:
+            try:
+                os.remove(file_path(fid))
+            except FileNotFoundError:
+                pass
+            GC_DELETED.labels(reason).inc()
+        return len(victims)
+ 
+    def adopt_incoming(self, incoming_dir):
+        # 他のプロセスが直接書き込んだファイルを最新として取り込み，目印を消す
+        try:
+            entries = list(os.scandir(incoming_dir))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            path = file_path(entry.name)
+            if path and os.path.isfile(path):
+                self.add(entry.name, time.time(), os.path.getsize(path))
+            os.remove(entry.path)
+        return len(entries)
+ 
+    def __len__(self):
+        return len(self._files)
+ 
+index = FileIndex(TMP_DIR, INDEX_DB_PATH)
+ 
+async def gc_loop():
+    # 参照時刻の SQLite への反映も兼ねるので，FILE_TTL_HOURS・MAX_TOTAL_MB がともに 0 でも回す
+    while True:
+        await asyncio.sleep(GC_INTERVAL_SECONDS)
+        deleted = await asyncio.to_thread(index.collect, FILE_TTL_HOURS * 3600, int(MAX_TOTAL_MB * 2**20))
+        await asyncio.to_thread(index.flush)
+        if deleted:
+            logger.info("gc: deleted %d files (%d files, %d bytes left)", deleted, len(index), index.total_bytes)
+ 
+async def incoming_loop():
+    while True:
+        await asyncio.to_thread(index.adopt_incoming, INCOMING_DIR)
+        await asyncio.sleep(INCOMING_POLL_SECONDS)
+ 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = [asyncio.create_task(gc_loop()), asyncio.create_task(incoming_loop())]
+    yield
+    for task in tasks:
+        task.cancel()
+    index.flush()
+ 
+app = FastAPI(title="Image File Server", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -17,30 +222,131 @@ app.add_middleware(
     allow_headers=["*"]
 )
  
-@app.post("/upload")
-async def upload(file: UploadFile = File(...)):
-    data = await file.read()
-    if not data:
-        raise HTTPException(400, "empty file upload")
+@app.middleware("http")
+async def reject_large_upload(request: Request, call_next):
+    # フォームの解析（一時ファイルへの書き出し）が始まる前に，Content-Length で大きすぎるアップロードを断る．
+    # Content-Length がない（chunked）場合は upload() の中で書き込みながら確かめる
+    if request.method == "POST" and request.url.path == "/upload":
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD:
+            return JSONResponse({"detail": f"file exceeds {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+    return await call_next(request)
+ 
+@app.middleware("http")
+async def record_request_seconds(request: Request, call_next):
+    # ルートのパステンプレート（/i/{fid} など）ごとに所要時間を記録する
+    start = time.monotonic()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(request.method, route.path if route else "unmatched",
+                           response.status_code).observe(time.monotonic() - start)
+    return response
  
+@app.get("/metrics")
+def metrics():
+    STORED_FILES.set(len(index))
+    STORED_BYTES.set(index.total_bytes)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+ 
+@app.post("/upload")
+def upload(file: UploadFile = File(...)):
     ext = pathlib.Path(file.filename).suffix.lower() or ".bin"
     if ext not in [".png", ".jpg", ".jpeg", ".webp", ".gif", ".svg", ".mp4", "webm"]:
         ext = ".bin"
-    fid = f"{uuid.uuid4().hex}{ext}"
-    path = os.path.join(TMP_DIR, fid)
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(413, f"file exceeds {MAX_UPLOAD_BYTES} bytes")
  
-    with open(path, "wb") as f:
-        f.write(data)
-    os.utime(path, None)
+    # 一時ファイルへ少しずつ書き込みながらハッシュを取り，書き終えてから rename する
+    # （読み手が書きかけのファイルを見ない）．同じ内容が既にあれば一時ファイルは捨てる
+    tmp_path = os.path.join(TMP_DIR, f".tmp-{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while chunk := file.file.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(413, f"file exceeds {MAX_UPLOAD_BYTES} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        if not size:
+            raise HTTPException(400, "empty file upload")
+        fid = f"{digest.hexdigest()[:32]}{ext}"
+        path = file_path(fid)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            DEDUPLICATED.inc()
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    index.add(fid, time.time(), size)
+    UPLOADS.inc()
+    UPLOAD_BYTES.inc(size)
     return {"url": f"/i/{fid}"}
  
+# ID は内容から決まり，同じ ID の内容は変わらないので，ID をそのまま強い ETag にして長期間キャッシュさせる
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+ 
+def _byte_range(header, size):
+    # Range ヘッダ（単一範囲のみ対応）を (開始, 終了) に変換する．対応しない形式なら None（全体を返す）．
+    # 終了位置が開始位置より前の指定（bytes=5-2）は不正な Range として無視する（RFC 7233 2.1）
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", (header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first and last and int(last) < int(first):
+        return None
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(0, size - int(last)), size - 1
+    if start >= size:
+        raise HTTPException(416, "range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+ 
+def _read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(UPLOAD_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+ 
 @app.get("/i/{fid}")
-def get_file(fid: str):
-    path = os.path.join(TMP_DIR, fid)
-    if not os.path.isfile(path):
+def get_file(fid: str, request: Request):
+    path = file_path(fid)
+    if path is None or not os.path.isfile(path):
         raise HTTPException(404, "not found")
-    os.utime(path, None)
-    return FileResponse(path)
+    size = os.path.getsize(path)
+    if not index.touch(fid, time.time()):
+        index.add(fid, os.path.getmtime(path), size)  # 他のプロセスが直接書いたファイル
+    etag = f'"{fid.split(".")[0]}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    # If-None-Match は弱い比較（W/ 付きでも一致とみなす）．"*" はファイルがあれば常に一致
+    if_none_match = [t.strip().removeprefix("W/") for t in request.headers.get("if-none-match", "").split(",")]
+    if etag in if_none_match or "*" in if_none_match:
+        return Response(status_code=304, headers=headers)
+    byte_range = None
+    if request.headers.get("if-range") in (None, etag):
+        byte_range = _byte_range(request.headers.get("range"), size)
+    if byte_range is None and "range" not in request.headers:
+        return FileResponse(path, headers=headers)
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if byte_range is None:
+        # 無視した Range（不正な指定・複数範囲・If-Range の不一致）は全体を 200 で返す．
+        # FileResponse は Range を自分で解釈し直して bytes=5-2 などに 400 を返すので，ここでは使わない
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_read_range(path, 0, size - 1), headers=headers, media_type=media_type)
+    start, end = byte_range
+    headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+    return StreamingResponse(_read_range(path, start, end), status_code=206, headers=headers, media_type=media_type)
  
 def require_bearer_token(request: Request):
     auth: Optional[str] = request.headers.get("Authorization")
@@ -52,19 +358,14 @@ def require_bearer_token(request: Request):
  
 @app.get("/latest")
 def latest(request: Request, _: None = Depends(require_bearer_token)):
-    files = [os.path.join(TMP_DIR, f) for f in os.listdir(TMP_DIR)]
-    files = [f for f in files if os.path.isfile(f)]
-    if not files:
+    entry = index.latest()
+    if entry is None:
         raise HTTPException(404, "no files")
- 
-    latest_file = max(files, key=os.path.getmtime)
-    fid = os.path.basename(latest_file)
+    fid, mtime = entry
  
     # 日本時間（UTC+9）での更新日時
     jst = datetime.timezone(datetime.timedelta(hours=9))
-    mtime = datetime.datetime.fromtimestamp(
-        os.path.getmtime(latest_file), tz=jst
-    )
+    mtime = datetime.datetime.fromtimestamp(mtime, tz=jst)
  
     # caddyを通すと"http://"で返すので，"https://"に書き換える
     return {
@@ -74,15 +375,11 @@ def latest(request: Request, _: None = Depends(require_bearer_token)):
  
 @app.get("/latest/raw")
 def latest_raw(_: None = Depends(require_bearer_token)):
-    files = [os.path.join(TMP_DIR, f) for f in os.listdir(TMP_DIR)]
-    files = [f for f in files if os.path.isfile(f)]
-    if not files:
+    entry = index.latest()
+    if entry is None:
         raise HTTPException(404, "no files")
- 
-    latest_file = max(files, key=os.path.getmtime)
-    return FileResponse(latest_file)
+    return FileResponse(file_path(entry[0]))
  
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8010)
-
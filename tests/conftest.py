@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+# リポジトリ直下のスクリプト（flux_imaging_api.py など）を import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def stub_api():
+    # flux_benchmark の stub パイプライン（遅延なし）に差し替えた API．推論ワーカーも動かす
+    import flux_benchmark
+    import flux_imaging_api as api
+    flux_benchmark.STUB_LATENCY.update({stage: 0.0 for stage in flux_benchmark.STUB_LATENCY})
+    flux_benchmark.install_backend(api, "stub")
+    api.executor.start()
+    return api
+
+
+@pytest.fixture
+def api_client(stub_api):
+    from fastapi.testclient import TestClient
+    return TestClient(stub_api.app)  # with を使わないので lifespan（ジョブワーカーなど）は動かない
+
+
+@pytest.fixture
+def file_store(tmp_path, monkeypatch):
+    # image_file_server の保存先を一時ディレクトリにし，そこへファイルを置く関数を返す
+    import image_file_server as server
+    monkeypatch.setattr(server, "TMP_DIR", str(tmp_path))
+
+    def write(fid, data, mtime=None):
+        path = server.file_path(fid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    write.directory = str(tmp_path)
+    return write
+
+
+@pytest.fixture
+def file_server_client(file_store, monkeypatch):
+    import image_file_server as server
+    from fastapi.testclient import TestClient
+    monkeypatch.setattr(server, "index", server.FileIndex(file_store.directory))
+    return TestClient(server.app)  # with を使わないので lifespan（GC）は動かない
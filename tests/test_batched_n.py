@@ -0,0 +1,62 @@
+import asyncio
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+import flux_imaging_api as api
+
+
+def test_batch_limit_caps_pixels_per_call(monkeypatch):
+    monkeypatch.setattr(api, "BATCH_MAX_SIZE", 4)
+    monkeypatch.setattr(api, "BATCH_MAX_PIXELS", 2 * 1024 * 1024)
+    assert api._batch_limit(("generate", 1024, 1024)) == 2
+    assert api._batch_limit(("generate", 512, 512)) == 4     # BATCH_MAX_SIZE で頭打ち
+    assert api._batch_limit(("generate", 2048, 2048)) == 1   # 1 枚で上限を超えても 1 枚ずつは実行する
+
+
+def test_submit_counts_every_image_against_the_queue():
+    executor = api.InferenceExecutor(lambda key, payloads, is_cancelled: payloads, 4)  # 未起動
+
+    async def main():
+        executor.submit("k", [1, 2, 3])
+        with pytest.raises(api.QueueFullError):
+            executor.submit("k", [4, 5])
+        executor.submit("k", [4])
+
+    asyncio.run(main())
+    assert executor.stats()["pending"] == 4
+
+
+def test_submit_accepts_oversized_request_on_empty_queue():
+    executor = api.InferenceExecutor(lambda key, payloads, is_cancelled: payloads, 4)
+
+    async def main():
+        executor.submit("k", list(range(6)))
+        with pytest.raises(api.QueueFullError):
+            executor.submit("k", [6])
+
+    asyncio.run(main())
+    assert executor.stats()["pending"] == 6
+
+
+@pytest.mark.parametrize("n", [0, -1, api.MAX_N + 1, "2", 1.5])
+def test_generations_rejects_invalid_n(api_client, n):
+    resp = api_client.post("/v1/images/generations",
+                           json={"prompt": "a cat", "size": "64x64", "n": n, "response_format": "b64_json"})
+    assert resp.status_code == 400
+    assert "n must be" in resp.json()["error"]
+
+
+def test_generations_returns_n_images_with_consecutive_seeds(api_client, monkeypatch):
+    # 2 枚ずつのチャンクに分かれても，n 枚すべてが seed 順に返る
+    monkeypatch.setattr(api, "BATCH_MAX_PIXELS", 2 * 64 * 64)
+    resp = api_client.post("/v1/images/generations", json={
+        "prompt": "a cat", "size": "64x64", "n": 5, "seed": 10, "response_format": "b64_json",
+    })
+    assert resp.status_code == 200
+    data = resp.json()["data"]
+    assert [d["seed"] for d in data] == [10, 11, 12, 13, 14]
+    sizes = {Image.open(io.BytesIO(base64.b64decode(d["b64_json"]))).size for d in data}
+    assert sizes == {(64, 64)}
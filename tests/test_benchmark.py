@@ -0,0 +1,38 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+
+import flux_benchmark
+
+
+def test_percentile_interpolates():
+    assert flux_benchmark.percentile([4, 1, 3, 2], 50) == 2.5
+    assert flux_benchmark.percentile([1, 2, 3, 4, 5], 100) == 5
+    assert flux_benchmark.percentile([], 50) is None
+
+
+class _FailingClient:
+    # 最初の failures 回は接続エラー，その後は 503 を返すクライアント
+    def __init__(self, failures):
+        self.failures = failures
+
+    async def post(self, url, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise httpx.ReadError("connection closed")
+        return httpx.Response(503)
+
+
+def _args(**overrides):
+    args = dict(warmup=2, requests=3, n=1, mode="generate", width=64, height=64, steps=None,
+                output_format="png", unique_prompts=1, seed_base=0)
+    return SimpleNamespace(**{**args, **overrides})
+
+
+def test_run_scenario_reports_failed_warmup_and_requests():
+    report = asyncio.run(flux_benchmark.run_scenario(_FailingClient(3), "process", 2, _args(), b""))
+    assert report["warmup_errors"] == {"ReadError": 2}
+    assert report["errors"] == {"ReadError": 1, "503": 2}
+    assert report["ok"] == 0
+    assert report["latency"]["p50"] is None
@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import pytest
+
+import flux_imaging_api as api
+
+
+def test_parse_jsonl_keeps_original_line_numbers():
+    text = '{"prompt": "a"}\n\n   \n{"prompt": "b"}\n'
+    assert api.parse_jsonl(text) == [(0, {"prompt": "a"}), (3, {"prompt": "b"})]
+
+
+@pytest.mark.parametrize("line", ["[]", "3", '"prompt"', "null"])
+def test_parse_jsonl_rejects_non_object_lines(line):
+    with pytest.raises(ValueError, match="line 2"):
+        api.parse_jsonl('{"prompt": "a"}\n' + line)
+
+
+def test_parse_jsonl_rejects_broken_json():
+    with pytest.raises(ValueError):
+        api.parse_jsonl('{"prompt": ')
+
+
+def test_completed_indices_collects_only_successful_records():
+    text = "\n".join([
+        json.dumps({"index": 0, "status": "ok"}),
+        json.dumps({"index": 1, "status": "error", "error": "boom"}),
+        json.dumps({"index": 4, "status": "ok"}),
+        "[1, 2]",
+        json.dumps({"status": "ok"}),
+        '{"index": 5, "sta',  # 書き込み途中で止まった最後の行
+    ])
+    assert api.completed_indices(text) == {0, 4}
+
+
+def test_bulk_sort_key_groups_same_mode_and_size():
+    items = api.parse_jsonl("\n".join(json.dumps(p) for p in [
+        {"prompt": "a", "width": 512, "height": 512},
+        {"input_image_url": "http://x/a.png"},
+        {"prompt": "b", "width": 1024, "height": 1024},
+        {"prompt": "c", "width": 512, "height": 512},
+    ]))
+    order = [i for i, _ in sorted(items, key=lambda item: api._bulk_sort_key(item[1]))]
+    assert order.index(3) == order.index(0) + 1
+
+
+def _collect(agen):
+    async def main():
+        return [record async for record in agen]
+    return asyncio.run(main())
+
+
+def test_run_bulk_bounds_work_in_flight(monkeypatch):
+    state = {"running": 0, "peak": 0, "tasks": 0}
+
+    async def fake_process(**params):
+        state["running"] += 1
+        state["peak"] = max(state["peak"], state["running"])
+        state["tasks"] = max(state["tasks"], len(asyncio.all_tasks()))
+        await asyncio.sleep(0.001)
+        state["running"] -= 1
+        if params["prompt"] == "bad":
+            raise ValueError("bad prompt")
+        return {"prompt": params["prompt"]}
+
+    monkeypatch.setattr(api, "BULK_CONCURRENCY", 3)
+    monkeypatch.setattr(api, "_process_with_retry", fake_process)
+    items = [(i, {"prompt": "bad" if i == 7 else f"p{i}"}) for i in range(50)]
+    records = _collect(api.run_bulk(items, skip={0, 1}))
+    assert state["peak"] == 3
+    assert state["tasks"] <= 4  # ワーカー 3 個 + 読み手（行ごとの Task は作らない）
+    assert sorted(r["index"] for r in records) == list(range(2, 50))
+    assert [r for r in records if r["status"] == "error"] == [{"index": 7, "status": "error", "error": "bad prompt"}]
+
+
+def test_run_bulk_cancels_work_when_reader_stops(monkeypatch):
+    started, cancelled = [], []
+
+    async def fake_process(**params):
+        started.append(params["prompt"])
+        try:
+            await asyncio.sleep(0 if params["prompt"] == "p0" else 10)
+        except asyncio.CancelledError:
+            cancelled.append(params["prompt"])
+            raise
+        return {}
+
+    monkeypatch.setattr(api, "BULK_CONCURRENCY", 2)
+    monkeypatch.setattr(api, "_process_with_retry", fake_process)
+
+    async def main():
+        agen = api.run_bulk([(i, {"prompt": f"p{i}"}) for i in range(10)])
+        first = await agen.__anext__()
+        await agen.aclose()  # クライアントの切断
+        await asyncio.sleep(0)
+        return first
+
+    assert asyncio.run(main())["index"] == 0
+    assert len(started) <= 3
+    assert cancelled
+
+
+def test_batch_endpoint_streams_ndjson(api_client):
+    body = "\n".join(json.dumps({"prompt": f"cat {i}", "seed": i, "width": 64, "height": 64,
+                                 "num_inference_steps": 1}) for i in range(3))
+    resp = api_client.post("/v1/images/batch", content=body)
+    assert resp.status_code == 200
+    records = [json.loads(line) for line in resp.text.splitlines()]
+    assert sorted((r["index"], r["status"], r["seed"]) for r in records) == [(0, "ok", 0), (1, "ok", 1), (2, "ok", 2)]
+
+
+def test_batch_endpoint_rejects_non_object_lines(api_client):
+    resp = api_client.post("/v1/images/batch", content='{"prompt": "a"}\n[1]\n')
+    assert resp.status_code == 400
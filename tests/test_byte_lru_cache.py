@@ -0,0 +1,40 @@
+import flux_imaging_api as api
+
+
+def test_byte_lru_evicts_least_recently_used_over_budget():
+    cache = api.ByteLRUCache(10)
+    cache.put("a", 1, 4)
+    cache.put("b", 2, 4)
+    assert cache.get("a") == 1  # a を新しくする
+    cache.put("c", 3, 4)        # 12 バイト > 10 なので最も古い b を捨てる
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.bytes == 8
+    assert cache.evictions == 1
+
+
+def test_byte_lru_replaces_existing_key_without_double_counting():
+    cache = api.ByteLRUCache(10)
+    cache.put("a", 1, 4)
+    cache.put("a", 2, 6)
+    assert cache.get("a") == 2
+    assert cache.bytes == 6
+    assert cache.evictions == 0
+
+
+def test_byte_lru_skips_values_larger_than_budget():
+    cache = api.ByteLRUCache(10)
+    cache.put("a", 1, 4)
+    cache.put("big", 2, 11)
+    assert cache.get("big") is None
+    assert cache.get("a") == 1
+    assert cache.stats()["entries"] == 1
+
+
+def test_byte_lru_counts_hits_and_misses():
+    cache = api.ByteLRUCache(10)
+    cache.put("a", 1, 1)
+    cache.get("a")
+    cache.get("missing")
+    assert (cache.hits, cache.misses) == (1, 1)
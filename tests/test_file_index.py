@@ -0,0 +1,78 @@
+import hashlib
+import os
+
+import image_file_server as server
+
+FIDS = [f"{c * 32}.png" for c in "abcd"]
+
+
+def _index_of(file_store, count, db_path=None):
+    # 10 バイトのファイルを count 個，古い順に置いて索引を作る
+    for i, fid in enumerate(FIDS[:count]):
+        file_store(fid, b"x" * 10, 1000 + i)
+    return server.FileIndex(file_store.directory, db_path)
+
+
+def test_file_index_collects_least_recently_accessed_first(file_store):
+    index = _index_of(file_store, 4)
+    assert index.total_bytes == 40
+    assert index.touch(FIDS[0], 2000)  # 最も古い a を参照する
+    assert index.collect(0, 25) == 2   # 参照の古い b, c から消す
+    assert not os.path.exists(server.file_path(FIDS[1]))
+    assert not os.path.exists(server.file_path(FIDS[2]))
+    assert os.path.exists(server.file_path(FIDS[0]))
+    assert index.total_bytes == 20
+    assert index.latest()[0] == FIDS[3]
+
+
+def test_file_index_collects_expired_files(file_store, monkeypatch):
+    index = _index_of(file_store, 3)
+    index.touch(FIDS[0], 5000)
+    monkeypatch.setattr(server.time, "time", lambda: 5050)
+    assert index.collect(100, 0) == 2
+    assert len(index) == 1
+    assert index.latest()[0] == FIDS[0]
+
+
+def test_file_index_keeps_everything_without_limits(file_store):
+    index = _index_of(file_store, 4)
+    assert index.collect(0, 0) == 0
+    assert len(index) == 4
+
+
+def test_file_index_restores_access_order_from_db(file_store):
+    db_path = os.path.join(file_store.directory, "index.sqlite3")
+    index = _index_of(file_store, 3, db_path)
+    index.touch(FIDS[0], 3000)
+    index.flush()
+    reopened = server.FileIndex(file_store.directory, db_path)
+    assert reopened.collect(0, 10) == 2
+    assert os.path.exists(server.file_path(FIDS[0]))
+
+
+def test_file_index_latest_follows_uploads(file_store):
+    index = _index_of(file_store, 2)
+    assert index.latest()[0] == FIDS[1]
+    index.add(FIDS[0], 3000, 10)  # 同じ内容の再アップロードも最新になる
+    assert index.latest() == (FIDS[0], 3000)
+
+
+def test_upload_deduplicates_by_content(file_server_client):
+    data = b"\x89PNG fake image"
+    first = file_server_client.post("/upload", files={"file": ("a.png", data, "image/png")}).json()
+    second = file_server_client.post("/upload", files={"file": ("b.png", data, "image/png")}).json()
+    assert first == second == {"url": f"/i/{hashlib.sha256(data).hexdigest()[:32]}.png"}
+    assert len(server.index) == 1
+
+
+def test_upload_rejects_empty_file(file_server_client):
+    resp = file_server_client.post("/upload", files={"file": ("a.png", b"", "image/png")})
+    assert resp.status_code == 400
+
+
+def test_upload_rejects_large_content_length(file_server_client, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_BYTES", 10)
+    monkeypatch.setattr(server, "UPLOAD_FORM_OVERHEAD", 0)
+    resp = file_server_client.post("/upload", files={"file": ("a.png", b"y" * 100, "image/png")})
+    assert resp.status_code == 413
+    assert len(server.index) == 0
@@ -0,0 +1,87 @@
+import pytest
+from fastapi import HTTPException
+
+import image_file_server as server
+
+FID = f"{'a' * 32}.png"
+
+
+@pytest.fixture
+def client(file_store, file_server_client):
+    file_store(FID, b"0123456789", 1000)
+    return file_server_client
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-4", (0, 4)),
+    ("bytes=5-", (5, 9)),
+    ("bytes=-3", (7, 9)),
+    ("bytes=-20", (0, 9)),
+    ("bytes=8-100", (8, 9)),
+    ("bytes=3-3", (3, 3)),
+    (None, None),
+    ("", None),
+    ("bytes=-", None),
+    ("bytes=0-1,4-5", None),
+    ("items=0-4", None),
+    ("bytes=5-2", None),  # 終了 < 開始は不正な Range なので全体を返す
+])
+def test_byte_range(header, expected):
+    assert server._byte_range(header, 10) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=10-", "bytes=10-20", "bytes=-0"])
+def test_byte_range_not_satisfiable(header):
+    with pytest.raises(HTTPException) as exc:
+        server._byte_range(header, 10)
+    assert exc.value.status_code == 416
+    assert exc.value.headers["Content-Range"] == "bytes */10"
+
+
+def test_get_file_sets_immutable_cache_headers(client):
+    resp = client.get(f"/i/{FID}")
+    assert resp.status_code == 200
+    assert resp.content == b"0123456789"
+    assert resp.headers["ETag"] == f'"{"a" * 32}"'
+    assert resp.headers["Cache-Control"] == server.CACHE_CONTROL
+
+
+@pytest.mark.parametrize("if_none_match", [f'"{"a" * 32}"', f'W/"{"a" * 32}"', f'"x", "{"a" * 32}"', "*"])
+def test_get_file_not_modified(client, if_none_match):
+    resp = client.get(f"/i/{FID}", headers={"If-None-Match": if_none_match})
+    assert resp.status_code == 304
+
+
+def test_get_file_modified_for_other_etag(client):
+    resp = client.get(f"/i/{FID}", headers={"If-None-Match": '"other"'})
+    assert resp.status_code == 200
+
+
+def test_get_file_range(client):
+    resp = client.get(f"/i/{FID}", headers={"Range": "bytes=2-4"})
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == "bytes 2-4/10"
+    assert resp.content == b"234"
+
+
+@pytest.mark.parametrize("header", ["bytes=5-2", "bytes=0-1,4-5"])
+def test_get_file_ignores_unsupported_range(client, header):
+    resp = client.get(f"/i/{FID}", headers={"Range": header})
+    assert resp.status_code == 200
+    assert resp.content == b"0123456789"
+
+
+def test_get_file_ignores_range_when_if_range_differs(client):
+    resp = client.get(f"/i/{FID}", headers={"Range": "bytes=2-4", "If-Range": '"other"'})
+    assert resp.status_code == 200
+    assert resp.content == b"0123456789"
+
+
+def test_get_file_range_not_satisfiable(client):
+    resp = client.get(f"/i/{FID}", headers={"Range": "bytes=10-"})
+    assert resp.status_code == 416
+
+
+def test_get_file_unknown_id(client):
+    assert client.get(f"/i/{'b' * 32}.png").status_code == 404
+    assert client.get("/i/not-an-id").status_code == 404
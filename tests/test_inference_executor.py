@@ -0,0 +1,152 @@
+import asyncio
+import threading
+
+import pytest
+
+import flux_imaging_api as api
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_submit_resolves_futures_from_worker_thread():
+    threads = []
+
+    def run_batch(key, payloads, is_cancelled):
+        threads.append(threading.current_thread().name)
+        return [p * 2 for p in payloads]
+
+    executor = api.InferenceExecutor(run_batch, 4)
+    executor.start()
+
+    async def main():
+        return await asyncio.gather(*executor.submit("k", [1]), *executor.submit("k", [2]))
+
+    assert _run(main()) == [2, 4]
+    assert threads and all(name == "inference-worker" for name in threads)
+
+
+def test_submit_propagates_pipeline_errors():
+    def run_batch(key, payloads, is_cancelled):
+        raise RuntimeError("boom")
+
+    executor = api.InferenceExecutor(run_batch, 4)
+    executor.start()
+
+    async def main():
+        await asyncio.gather(*executor.submit("k", [1]))
+
+    with pytest.raises(RuntimeError, match="boom"):
+        _run(main())
+
+
+def test_submit_raises_queue_full_with_retry_after():
+    executor = api.InferenceExecutor(lambda key, payloads, is_cancelled: payloads, 2)  # 未起動なので溜まるだけ
+
+    async def main():
+        executor.submit("k", [1])
+        executor.submit("k", [2])
+        with pytest.raises(api.QueueFullError) as exc:
+            executor.submit("k", [3])
+        return exc.value.retry_after
+
+    assert _run(main()) >= 1
+    assert executor.stats()["pending"] == 2
+
+
+def test_retry_after_scales_with_depth():
+    executor = api.InferenceExecutor(lambda key, payloads, is_cancelled: payloads, 8)
+    executor._avg_seconds = 3.0
+
+    async def main():
+        executor.submit("k", [1, 2])
+        return executor.retry_after()
+
+    assert _run(main()) == 6
+
+
+def test_process_returns_503_when_queue_is_full(api_client, monkeypatch):
+    def queue_full(key, payloads):
+        raise api.QueueFullError(12)
+
+    monkeypatch.setattr(api.executor, "submit", queue_full)
+    resp = api_client.post("/process", data={"prompt": "a cat", "width": 64, "height": 64})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "12"
+    assert resp.json()["error"] == "inference queue is full"
+
+
+def _recording_executor(limit, max_wait=0.0):
+    # 呼び出しごとの (key, payloads) を記録する，未起動の executor
+    calls = []
+
+    def run_batch(key, payloads, is_cancelled):
+        calls.append((key, list(payloads)))
+        return payloads
+
+    return api.InferenceExecutor(run_batch, 16, lambda key: limit, max_wait), calls
+
+
+def test_batches_group_only_equal_keys():
+    executor, calls = _recording_executor(4)
+
+    async def main():
+        futures = (executor.submit("a", [1]) + executor.submit("b", [2])
+                   + executor.submit("a", [3]) + executor.submit("a", [4]))
+        executor.start()  # 4 件が溜まった状態から取り出させる
+        return await asyncio.gather(*futures)
+
+    assert _run(main()) == [1, 2, 3, 4]
+    assert calls == [("a", [1, 3, 4]), ("b", [2])]
+
+
+def test_batches_respect_batch_limit():
+    executor, calls = _recording_executor(2)
+
+    async def main():
+        futures = executor.submit("a", [1, 2, 3, 4, 5])
+        executor.start()
+        return await asyncio.gather(*futures)
+
+    assert _run(main()) == [1, 2, 3, 4, 5]
+    assert [payloads for _, payloads in calls] == [[1, 2], [3, 4], [5]]
+
+
+def test_batches_wait_for_late_arrivals():
+    executor, calls = _recording_executor(4, max_wait=0.5)
+    executor.start()
+
+    async def main():
+        first = executor.submit("a", [1])
+        await asyncio.sleep(0.05)  # max_wait の間に届いた同じ key の仕事はまとめられる
+        second = executor.submit("a", [2])
+        return await asyncio.gather(*first, *second)
+
+    assert _run(main()) == [1, 2]
+    assert calls == [("a", [1, 2])]
+
+
+def test_batches_skip_cancelled_items():
+    executor, calls = _recording_executor(4)
+
+    async def main():
+        cancelled = executor.submit("a", [1])
+        kept = executor.submit("a", [2])
+        cancelled[0].cancel()
+        executor.start()
+        return await asyncio.gather(*kept)
+
+    assert _run(main()) == [2]
+    assert calls == [("a", [2])]
+
+
+def test_batch_key_separates_incompatible_requests():
+    small = api.Image.new("RGB", (64, 64))
+    large = api.Image.new("RGB", (128, 64))
+    assert api._batch_key("generate", 3.5, 28, 64, 64, None) == api._batch_key("generate", 3.5, 28, 64, 64, None)
+    assert api._batch_key("generate", 3.5, 28, 64, 64, None) != api._batch_key("generate", 3.5, 20, 64, 64, None)
+    assert api._batch_key("generate", 3.5, 28, 64, 64, None) != api._batch_key("variation", 3.5, 28, 64, 64, small)
+    # edit は入力画像をそのままバッチにするので，入力画像のサイズが違うものはまとめない
+    assert api._batch_key("edit", 2.5, 28, 64, 64, small) != api._batch_key("edit", 2.5, 28, 64, 64, large)
+    assert api._batch_key("variation", 2.5, 28, 64, 64, small) == api._batch_key("variation", 2.5, 28, 64, 64, large)
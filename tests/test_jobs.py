@@ -0,0 +1,94 @@
+import json
+import sqlite3
+import time
+
+import pytest
+
+import flux_imaging_api as api
+
+
+@pytest.fixture
+def store(tmp_path):
+    return api.JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_job_store_claims_by_priority_then_age(store):
+    low = store.add({"prompt": "low"})
+    first = store.add({"prompt": "first"}, priority=5)
+    second = store.add({"prompt": "second"}, priority=5)
+    assert [store.claim()["id"] for _ in range(3)] == [first, second, low]
+    assert store.claim() is None
+    assert store.counts() == {"running": 3}
+
+
+def test_job_store_requeues_interrupted_jobs(store):
+    job_id = store.add({"prompt": "a"})
+    store.claim()
+    assert store.requeue_running() == 1
+    assert store.get(job_id)["status"] == "queued"
+    assert store.claim()["id"] == job_id
+
+
+def test_job_store_finish_and_cancel(store):
+    done = store.add({"prompt": "a"}, input_file=b"png", input_filename="a.png")
+    queued = store.add({"prompt": "b"})
+    store.claim()
+    store.finish(done, "succeeded", {"seed": 1})
+    assert store.cancel_queued(queued)
+    assert not store.cancel_queued(done)
+    assert store.get(done)["result"] == {"seed": 1}
+    assert store.get(queued)["status"] == "cancelled"
+    assert store.get("missing") is None
+
+
+def test_job_store_does_not_persist_bearer_token(store, tmp_path):
+    store.add({"prompt": "a", "bearer_token": "secret"})
+    conn = sqlite3.connect(str(tmp_path / "jobs.sqlite3"))
+    (params,) = conn.execute("SELECT params FROM jobs").fetchone()
+    assert "bearer_token" not in json.loads(params)
+    assert "secret" not in params
+
+
+@pytest.fixture(scope="module")
+def jobs_client(stub_api, tmp_path_factory):
+    # lifespan（ジョブストアとジョブワーカー）を動かす．停止フラグが残るのでモジュールで 1 回だけ起動する
+    from fastapi.testclient import TestClient
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(stub_api, "JOB_DB_PATH", str(tmp_path_factory.mktemp("jobs") / "jobs.sqlite3"))
+        with TestClient(stub_api.app) as client:
+            yield client
+
+
+def _wait(client, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_job_runs_to_completion(jobs_client):
+    resp = jobs_client.post("/jobs", data={"prompt": "a cat", "seed": 4, "width": 64, "height": 64,
+                                           "num_inference_steps": 1, "priority": 3})
+    assert resp.status_code == 202
+    assert resp.json()["status"] == "queued"
+    job = _wait(jobs_client, resp.json()["id"])
+    assert job["status"] == "succeeded"
+    assert job["result"]["seed"] == 4
+    assert job["result"]["result_image_base64"]
+    assert job["priority"] == 3
+
+
+def test_job_rejects_invalid_output_options(jobs_client):
+    resp = jobs_client.post("/jobs", data={"prompt": "a cat", "output_format": "bmp"})
+    assert resp.status_code == 400
+
+
+def test_cancel_unknown_and_finished_jobs(jobs_client):
+    assert jobs_client.delete("/jobs/missing").status_code == 404
+    job_id = jobs_client.post("/jobs", data={"prompt": "a cat", "width": 64, "height": 64,
+                                             "num_inference_steps": 1}).json()["id"]
+    _wait(jobs_client, job_id)
+    assert jobs_client.delete(f"/jobs/{job_id}").json() == {"id": job_id, "status": "succeeded"}
@@ -0,0 +1,65 @@
+import os
+
+import flux_imaging_api as api
+
+
+def test_result_cache_round_trip(tmp_path):
+    cache = api.ResultCache(str(tmp_path), 100)
+    cache.put("ab01", b"image", {"seed": 1})
+    assert cache.get("ab01") == (b"image", {"seed": 1})
+    assert cache.get("cd02") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_result_cache_evicts_lru_entries_and_files(tmp_path):
+    cache = api.ResultCache(str(tmp_path), 10)
+    cache.put("aa01", b"1234", {})
+    cache.put("bb02", b"1234", {})
+    cache.get("aa01")               # aa01 を新しくする
+    cache.put("cc03", b"1234", {})  # 12 バイト > 10 なので bb02 を削除する
+    assert cache.get("bb02") is None
+    assert not os.path.exists(tmp_path / "bb" / "bb02.bin")
+    assert not os.path.exists(tmp_path / "bb" / "bb02.json")
+    assert cache.get("aa01") is not None
+    assert cache.bytes == 8
+    assert cache.evictions == 1
+
+
+def test_result_cache_keeps_single_oversized_entry(tmp_path):
+    cache = api.ResultCache(str(tmp_path), 4)
+    cache.put("aa01", b"12", {})
+    cache.put("bb02", b"123456", {})
+    assert cache.get("aa01") is None
+    assert cache.get("bb02") == (b"123456", {})
+
+
+def test_result_cache_rebuilds_index_from_disk(tmp_path):
+    cache = api.ResultCache(str(tmp_path), 100)
+    cache.put("aa01", b"1234", {"seed": 1})
+    cache.put("bb02", b"12", {"seed": 2})
+    reopened = api.ResultCache(str(tmp_path), 100)
+    assert reopened.bytes == 6
+    assert reopened.get("bb02") == (b"12", {"seed": 2})
+
+
+def test_result_cache_drops_entry_whose_file_is_gone(tmp_path):
+    cache = api.ResultCache(str(tmp_path), 100)
+    cache.put("aa01", b"1234", {})
+    os.remove(tmp_path / "aa" / "aa01.bin")
+    assert cache.get("aa01") is None
+    assert cache.bytes == 0
+
+
+def test_result_cache_hit_is_stored_again(stub_api, api_client, tmp_path, monkeypatch):
+    # ファイルサーバが削除した後でも，キャッシュヒットの URL は保存し直されて有効
+    storage = api.MemoryStorage()
+    monkeypatch.setattr(api, "storage", storage)
+    monkeypatch.setattr(api, "result_cache", api.ResultCache(str(tmp_path), 2**20))
+    data = {"prompt": "a cat", "seed": 3, "width": 64, "height": 64, "num_inference_steps": 1}
+    first = api_client.post("/process", data=data).json()
+    assert first["cache_hit"] is False
+    storage.files.clear()
+    second = api_client.post("/process", data=data).json()
+    assert second["cache_hit"] is True
+    assert second["result_image_url"] == first["result_image_url"]
+    assert second["result_image_url"].removeprefix("memory://") in storage.files
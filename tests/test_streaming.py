@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import flux_imaging_api as api
+
+
+def _events(text):
+    # SSE の本文を [(イベント名, データ)] にする
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def _queue_full(key, payloads):
+    raise api.QueueFullError(7)
+
+
+def test_process_stream_sends_progress_and_result(api_client):
+    resp = api_client.post("/process/stream", data={"prompt": "a cat", "width": 64, "height": 64,
+                                                    "num_inference_steps": 2})
+    assert resp.status_code == 200
+    events = _events(resp.text)
+    assert [name for name, _ in events].count("progress") == 2
+    name, result = events[-1]
+    assert name == "result"
+    assert (result["width"], result["height"]) == (64, 64)
+
+
+def test_process_stream_queue_full_returns_503(api_client, monkeypatch):
+    monkeypatch.setattr(api.executor, "submit", _queue_full)
+    resp = api_client.post("/process/stream", data={"prompt": "a cat", "width": 64, "height": 64})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "7"
+
+
+def test_generations_stream_queue_full_returns_503(api_client, monkeypatch):
+    monkeypatch.setattr(api.executor, "submit", _queue_full)
+    resp = api_client.post("/v1/images/generations", json={"prompt": "a cat", "size": "64x64", "stream": True})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "7"
+
+
+def test_generations_stream_sends_completed_per_image(api_client):
+    resp = api_client.post("/v1/images/generations", json={
+        "prompt": "a cat", "size": "64x64", "n": 2, "seed": 5, "stream": True, "output_format": "jpeg",
+    })
+    assert resp.status_code == 200
+    completed = [data for name, data in _events(resp.text) if name == "image_generation.completed"]
+    assert [(d["index"], d["seed"]) for d in completed] == [(0, 5), (1, 6)]
+
+
+@pytest.mark.parametrize("partial_images", [-1, 4, "2", 1.5, True])
+def test_generations_rejects_invalid_partial_images(api_client, partial_images):
+    resp = api_client.post("/v1/images/generations", json={
+        "prompt": "a cat", "size": "64x64", "stream": True, "partial_images": partial_images,
+    })
+    assert resp.status_code == 400
+    assert "partial_images" in resp.json()["error"]
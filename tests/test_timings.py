@@ -0,0 +1,40 @@
+import flux_benchmark
+import flux_imaging_api as api
+
+
+def test_timed_accumulates():
+    timings = {}
+    with api.timed("encode", timings):
+        pass
+    first = timings["encode"]
+    with api.timed("encode", timings):
+        pass
+    assert timings["encode"] >= first
+
+
+def test_server_timing_header():
+    header = api.server_timing({"denoise": 0.25, "vae_decode": 0.0125})
+    assert header == "denoise;dur=250.0, vae_decode;dur=12.5"
+    assert flux_benchmark.parse_server_timing(header) == {"denoise": 0.25, "vae_decode": 0.0125}
+
+
+def test_batch_timings_add_up_across_chunks_once_per_request():
+    shared, other = {}, {"queue_wait": 1.0}
+    batch = [{"timings": shared}, {"timings": shared}, {"timings": other}]
+    api._add_batch_timings(batch, {"denoise": 2.0, "vae_decode": 0.5})
+    api._add_batch_timings(batch[:2], {"denoise": 3.0, "vae_decode": 0.25})  # 同じリクエストの次のチャンク
+    assert shared == {"denoise": 5.0, "vae_decode": 0.75}
+    assert other == {"queue_wait": 1.0, "denoise": 2.0, "vae_decode": 0.5}
+
+
+def test_server_timing_covers_every_chunk(api_client, monkeypatch):
+    # 1 枚ずつ 3 チャンクに分かれる n=3 のデノイズ時間は，1 チャンク分ではなく 3 チャンクの合計になる
+    monkeypatch.setitem(flux_benchmark.STUB_LATENCY, "step", 0.01)
+    monkeypatch.setattr(api, "BATCH_MAX_PIXELS", 64 * 64)
+    steps = api.DEFAULTS["generate"]["num_inference_steps"]
+    resp = api_client.post("/v1/images/generations", json={
+        "prompt": "a cat", "size": "64x64", "n": 3, "response_format": "b64_json",
+    })
+    assert resp.status_code == 200
+    timings = flux_benchmark.parse_server_timing(resp.headers["server-timing"])
+    assert timings["denoise"] >= 3 * steps * 0.01 * 0.9